@@ -4,23 +4,47 @@
 # Block 1/8 — Config, ENV, Logging, DB connection
 # ============================================================
 
+import io
 import os
+import re
 import sys
+import json
+import gzip
 import time
+import zlib
+import select
+import signal
+import random
+import bisect
 import logging
+import threading
+import argparse
+import functools
+import tempfile
 import traceback
-from contextlib import contextmanager
-from datetime import datetime, timedelta
+from array import array
+from collections import OrderedDict, deque
+from contextlib import contextmanager, ExitStack
+from datetime import date, datetime, timedelta
 
+import requests
 import telebot
 import psycopg2
 import psycopg2.extras
+import psycopg2.errors
+import psycopg2.pool
+from telebot import apihelper
+from telebot.apihelper import ApiTelegramException
+from requests.adapters import HTTPAdapter
+from flask import Flask, Response
 
 # ===================== ENV =====================
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL")
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL")  # optional read replica
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
+PORT = int(os.getenv("PORT", "8080"))
 
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN is not set")
@@ -32,8 +56,52 @@ if not DATABASE_URL:
 DAILY_TOPIC_LIMIT = 5
 REPLIES_PAGE_SIZE = 5
 TOPICS_PAGE_SIZE = 5
+REPORTS_PAGE_SIZE = 10
 RECONNECT_DELAY = 5  # seconds
 
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "0"))  # 0 = slow-query log off
+EXPLAIN_SAMPLE_RATE = float(os.getenv("EXPLAIN_SAMPLE_RATE", "0.1"))
+EXPLAIN_BUFFER_SIZE = int(os.getenv("EXPLAIN_BUFFER_SIZE", "20"))
+
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+REPLICA_RETRY_SECONDS = 30
+REPLICA_CONNECT_TIMEOUT = 3  # seconds; libpq waits forever by default
+REPLICA_STATEMENT_TIMEOUT_MS = 10_000
+READ_YOUR_WRITES_SECONDS = 10
+
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "2000"))  # topics
+
+ARCHIVE_AFTER_MONTHS = int(os.getenv("ARCHIVE_AFTER_MONTHS", "12"))  # detach older partitions
+PARTITIONS_AHEAD = 2  # months of partitions created in advance
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "5000"))  # rows per server-side cursor fetch
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "50000"))  # rows per COPY FROM STDIN
+
+STATS_FLUSH_SECONDS = 5  # write-behind interval for user_stats counters
+POPULAR_REFRESH_SECONDS = 60
+NOTIFY_WINDOW_SECONDS = 30  # reply notifications are coalesced per recipient over this window
+SHUTDOWN_NOTIFY_LIMIT = 100  # digests still sent on shutdown, ~4s of send budget
+DAILY_LIMITS_KEEP_DAYS = 7
+REPORTS_KEEP_DAYS = 90  # resolved reports
+
+TG_POOL_SIZE = int(os.getenv("TG_POOL_SIZE", "16"))  # keep-alive connections to api.telegram.org
+TG_CONNECT_TIMEOUT = float(os.getenv("TG_CONNECT_TIMEOUT", "5"))
+TG_READ_TIMEOUT = float(os.getenv("TG_READ_TIMEOUT", "15"))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "3"))
+TG_SEND_RATE = float(os.getenv("TG_SEND_RATE", "25"))  # messages/sec, Telegram allows ~30
+TG_SEND_BURST = float(os.getenv("TG_SEND_BURST", "25"))
+
+FLOOD_MSG_RATE = float(os.getenv("FLOOD_MSG_RATE", "0.5"))  # messages/sec per user
+FLOOD_MSG_BURST = float(os.getenv("FLOOD_MSG_BURST", "5"))
+FLOOD_CB_RATE = float(os.getenv("FLOOD_CB_RATE", "1"))  # button taps/sec per user
+FLOOD_CB_BURST = float(os.getenv("FLOOD_CB_BURST", "8"))
+FLOOD_TABLE_SIZE = 50_000  # users tracked, least recently seen are evicted
+
+BAN_CACHE_SIZE = 10_000
+BAN_CACHE_TTL = 300  # seconds; upper bound on staleness if a NOTIFY is missed
+SHUTDOWN_TIMEOUT = 20  # seconds to drain handlers; keep below fly.toml kill_timeout
+
 # ===================== LOGGING =====================
 
 logging.basicConfig(
@@ -46,31 +114,534 @@ logger = logging.getLogger("thoughts_bot")
 
 logger.info("Starting bot process...")
 
+# ===================== METRICS =====================
+# Minimal Prometheus text-format registry. Every update is a dict lookup
+# under one lock, cheap enough to stay on in production.
+
+METRICS = []
+_metrics_lock = threading.Lock()
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _fmt_labels(names, values) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{n}="' + str(v).replace("\\", "\\\\").replace('"', '\\"') + '"'
+        for n, v in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labels: tuple = ()):
+        self.name, self.doc, self.labels = name, doc, labels
+        self.values = {}
+        METRICS.append(self)
+
+    def inc(self, *labels, amount=1):
+        with _metrics_lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, _fmt_labels(self.labels, key), value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def __init__(self, name: str, doc: str, labels: tuple = (), fn=None):
+        super().__init__(name, doc, labels)
+        self.fn = fn
+
+    def set(self, value, *labels):
+        with _metrics_lock:
+            self.values[labels] = value
+
+    def samples(self):
+        if self.fn is not None:
+            try:
+                yield self.name, "", self.fn()
+            except Exception:
+                pass
+            return
+        yield from super().samples()
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labels: tuple = (), buckets=LATENCY_BUCKETS):
+        self.name, self.doc, self.labels = name, doc, labels
+        self.buckets = buckets
+        self.values = {}  # labels -> [bucket counts..., sum, count]
+        METRICS.append(self)
+
+    def observe(self, value: float, *labels):
+        idx = bisect.bisect_left(self.buckets, value)
+        with _metrics_lock:
+            row = self.values.get(labels)
+            if row is None:
+                row = self.values[labels] = [0] * (len(self.buckets) + 3)
+            row[idx] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    @contextmanager
+    def timer(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self):
+        names = self.labels + ("le",)
+        for key, row in self.values.items():
+            total = 0
+            for bound, count in zip(self.buckets, row):
+                total += count
+                yield f"{self.name}_bucket", _fmt_labels(names, key + (bound,)), total
+            yield f"{self.name}_bucket", _fmt_labels(names, key + ("+Inf",)), row[-1]
+            yield f"{self.name}_sum", _fmt_labels(self.labels, key), row[-2]
+            yield f"{self.name}_count", _fmt_labels(self.labels, key), row[-1]
+
+
+def render_metrics() -> str:
+    lines = []
+    with _metrics_lock:
+        for m in METRICS:
+            lines.append(f"# HELP {m.name} {m.doc}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            for name, labels, value in m.samples():
+                lines.append(f"{name}{labels} {value}")
+    return "\n".join(lines) + "\n"
+
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Handler latency by command / callback action", ("handler",))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Unhandled handler exceptions", ("handler",))
+DB_QUERY_SECONDS = Histogram("bot_db_query_seconds", "DB time by named query", ("query",))
+TG_API_SECONDS = Histogram("bot_telegram_api_seconds", "Telegram API call latency", ("method",))
+TG_API_CALLS = Counter("bot_telegram_api_calls_total", "Telegram API calls", ("method",))
+TG_API_ERRORS = Counter("bot_telegram_api_errors_total", "Telegram API errors", ("method", "code"))
+TG_API_THROTTLED = Counter("bot_telegram_api_429_total", "Telegram API 429 responses", ("method",))
+SLOW_QUERIES = Counter("bot_db_slow_queries_total", "Statements above SLOW_QUERY_MS")
+
+# ===================== SLOW QUERY LOG =====================
+
+SLOW_PLANS = deque(maxlen=EXPLAIN_BUFFER_SIZE)  # (timestamp, ms, sql, plan)
+
+_SQL_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+
+
+def normalize_sql(sql) -> str:
+    if isinstance(sql, bytes):
+        sql = sql.decode("utf-8", "replace")
+    return _SQL_LITERAL.sub("?", " ".join(str(sql).split()))
+
+
+class TimedCursor(psycopg2.extras.RealDictCursor):
+    """
+    Cursor that logs statements slower than SLOW_QUERY_MS.
+    Parameters are never logged; a sample of slow reads gets an
+    EXPLAIN (ANALYZE, BUFFERS) plan stored in SLOW_PLANS.
+    """
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        failed = True
+        try:
+            result = super().execute(query, vars)
+            failed = False
+            return result
+        finally:
+            ms = (time.perf_counter() - start) * 1000
+            if ms >= SLOW_QUERY_MS:
+                self._log_slow(query, vars, ms, failed)
+
+    def _log_slow(self, query, vars, ms, failed):
+        SLOW_QUERIES.inc()
+        sql = normalize_sql(query)
+        params = f"<{len(vars)} redacted>" if vars else "-"
+        logger.warning(f"Slow query {ms:.1f} ms | {sql} | params={params}")
+
+        # after an error the transaction is aborted and cannot run EXPLAIN
+        if failed or not self._explainable(sql) or random.random() >= EXPLAIN_SAMPLE_RATE:
+            return
+        try:
+            SLOW_PLANS.append((datetime.utcnow(), ms, sql, self._explain(query, vars)))
+        except Exception:
+            logger.error("EXPLAIN capture failed:")
+            logger.error(traceback.format_exc())
+
+    def _explainable(self, sql: str) -> bool:
+        # EXPLAIN ANALYZE really runs the statement, and plenty of SELECTs
+        # have side effects (advisory locks, pg_notify, nextval). Only
+        # allow-listed hot reads and statements on get_read_conn()
+        # connections qualify.
+        words = sql.split(None, 2)
+        if words[:1] == ["EXECUTE"] and len(words) > 1:
+            return words[1].split("(")[0] in READ_HOT_QUERIES
+        return self.connection.reader and sql[:6].upper() == "SELECT"
+
+    def _explain(self, query, vars):
+        conn = self.connection
+        cur = conn.cursor(cursor_factory=psycopg2.extensions.cursor)
+        savepoint = not conn.autocommit
+        if savepoint:
+            cur.execute("SAVEPOINT slowlog_explain")
+        try:
+            cur.execute(b"EXPLAIN (ANALYZE, BUFFERS) " + cur.mogrify(query, vars))
+            plan = "\n".join(row[0] for row in cur.fetchall())
+        except Exception:
+            if savepoint:
+                cur.execute("ROLLBACK TO SAVEPOINT slowlog_explain")
+            raise
+        if savepoint:
+            cur.execute("RELEASE SAVEPOINT slowlog_explain")
+        return plan
+
+
 # ===================== POSTGRES =====================
 
-@contextmanager
-def get_conn():
+class PooledConnection(psycopg2.extensions.connection):
     """
-    Safe PostgreSQL connection context manager.
-    Auto-commit / rollback.
+    Connection that remembers which hot queries it has PREPAREd, and
+    whether it is currently lent out by get_read_conn().
     """
-    conn = psycopg2.connect(
-        DATABASE_URL,
-        sslmode="require",
-        cursor_factory=psycopg2.extras.RealDictCursor
-    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.reader = False
+
+
+_pools = {}
+_pool_lock = threading.Lock()
+_pool_slots = {
+    "primary": threading.BoundedSemaphore(DB_POOL_MAX),
+    "replica": threading.BoundedSemaphore(DB_POOL_MAX),
+}
+_db_in_use = 0
+_db_waiting = 0
+
+DB_CONNECTIONS = Gauge("bot_db_connections_in_use", "Pooled connections checked out", fn=lambda: _db_in_use)
+DB_WAITING = Gauge("bot_db_pool_waiting", "Threads waiting for a pooled connection", fn=lambda: _db_waiting)
+DB_READS = Counter("bot_db_reads_total", "Read-only checkouts by target", ("target",))
+
+
+def get_pool(role: str = "primary"):
+    pool = _pools.get(role)
+    if pool is None:
+        with _pool_lock:
+            pool = _pools.get(role)
+            if pool is None:
+                extra = {}
+                dsn = DATABASE_URL
+                if role == "replica":
+                    # bounded connect, dead-peer detection and statement
+                    # time, so a hung replica fails over instead of
+                    # stalling every read
+                    dsn = DATABASE_REPLICA_URL
+                    extra.update(
+                        options=(
+                            "-c default_transaction_read_only=on"
+                            f" -c statement_timeout={REPLICA_STATEMENT_TIMEOUT_MS}"
+                        ),
+                        connect_timeout=REPLICA_CONNECT_TIMEOUT,
+                        keepalives=1,
+                        keepalives_idle=30,
+                        keepalives_interval=10,
+                        keepalives_count=3,
+                    )
+                pool = _pools[role] = psycopg2.pool.ThreadedConnectionPool(
+                    DB_POOL_MIN,
+                    DB_POOL_MAX,
+                    dsn,
+                    sslmode="require",
+                    connection_factory=PooledConnection,
+                    cursor_factory=TimedCursor if SLOW_QUERY_MS > 0 else psycopg2.extras.RealDictCursor,
+                    **extra
+                )
+    return pool
+
+
+@contextmanager
+def _checkout(role: str, query: str):
+    global _db_in_use, _db_waiting
+    start = time.perf_counter()
+
+    with _metrics_lock:
+        _db_waiting += 1
+    _pool_slots[role].acquire()
+    with _metrics_lock:
+        _db_waiting -= 1
+        _db_in_use += 1
+
+    pool = conn = None
     try:
+        pool = get_pool(role)
+        conn = pool.getconn()
         yield conn
         conn.commit()
     except Exception:
-        conn.rollback()
+        if conn is not None and not conn.closed:
+            conn.rollback()
         raise
     finally:
-        conn.close()
+        if conn is not None:
+            if not conn.closed and conn.autocommit:
+                conn.autocommit = False
+            pool.putconn(conn, close=bool(conn.closed))
+        _pool_slots[role].release()
+        with _metrics_lock:
+            _db_in_use -= 1
+        DB_QUERY_SECONDS.observe(time.perf_counter() - start, query)
+
+
+def get_conn(query: str = "other"):
+    """
+    Safe PostgreSQL connection context manager.
+    Auto-commit / rollback. Connections come from a bounded pool;
+    broken ones are closed instead of being returned.
+    Time spent is recorded under `query`.
+    """
+    return _checkout("primary", query)
+
+
+# ===================== READ REPLICA =====================
+
+_request = threading.local()  # user of the update being handled
+_recent_writes = {}  # user_id -> monotonic time of the last write
+_recent_writes_lock = threading.Lock()
+_replica_down_until = 0.0
+
+
+def current_user_id():
+    return getattr(_request, "user_id", None)
+
+
+def note_write(user_id: int):
+    """Pin the user's reads to the primary for READ_YOUR_WRITES_SECONDS."""
+    now = time.monotonic()
+    with _recent_writes_lock:
+        _recent_writes[user_id] = now
+        if len(_recent_writes) > 10_000:
+            for uid, ts in list(_recent_writes.items()):
+                if now - ts > READ_YOUR_WRITES_SECONDS:
+                    del _recent_writes[uid]
+
+
+def wrote_recently(user_id: int) -> bool:
+    ts = _recent_writes.get(user_id)
+    return ts is not None and time.monotonic() - ts < READ_YOUR_WRITES_SECONDS
+
+
+def mark_replica_down():
+    global _replica_down_until
+    if time.monotonic() >= _replica_down_until:
+        logger.warning(f"Read replica unavailable, using primary for {REPLICA_RETRY_SECONDS}s")
+    _replica_down_until = time.monotonic() + REPLICA_RETRY_SECONDS
+
+
+def replica_usable() -> bool:
+    if not DATABASE_REPLICA_URL or time.monotonic() < _replica_down_until:
+        return False
+    user_id = current_user_id()
+    return user_id is None or not wrote_recently(user_id)
+
+
+@contextmanager
+def _reading(conn):
+    conn.reader = True
+    try:
+        yield conn
+    finally:
+        conn.reader = False
+
+
+@contextmanager
+def get_read_conn(query: str = "other"):
+    """
+    Connection for read-only queries.
+    Uses DATABASE_REPLICA_URL when configured and healthy, unless the
+    current user has just written. Failing to reach the replica falls
+    over to the primary; a replica error mid-query is raised, and the
+    following reads go to the primary. Wrap read helpers in
+    @replica_read to have such an error retried on the primary.
+    """
+    if not replica_usable():
+        DB_READS.inc("primary")
+        with get_conn(query) as conn, _reading(conn):
+            yield conn
+        return
+
+    stack = ExitStack()
+    try:
+        conn = stack.enter_context(_checkout("replica", query))
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        mark_replica_down()
+        DB_READS.inc("failover")
+        with get_conn(query) as conn, _reading(conn):
+            yield conn
+        return
+
+    DB_READS.inc("replica")
+    with stack, _reading(conn):
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            mark_replica_down()
+            _request.replica_failed = True
+            raise
+
+
+def replica_read(func):
+    """Re-run a side-effect-free read once, on the primary, if the replica fails under it."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        _request.replica_failed = False
+        try:
+            return func(*args, **kwargs)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            if not _request.replica_failed:
+                raise
+            _request.replica_failed = False
+            DB_READS.inc("retried")
+            return func(*args, **kwargs)
+    return wrapper
+
+
+# ===================== INVALIDATION BUS (publish) =====================
+# Writers NOTIFY inside their own transaction, so other instances hear
+# about a change only once it is committed. See listen_invalidations().
+
+NOTIFY_PAYLOAD_LIMIT = 7000  # Postgres caps payloads at 8000 bytes
+
+
+def publish(cur, channel: str, ids):
+    payload = ""
+    for item in map(str, ids):
+        if payload and len(payload) + len(item) + 1 > NOTIFY_PAYLOAD_LIMIT:
+            cur.execute("SELECT pg_notify(%s, %s)", (channel, payload))
+            payload = ""
+        payload = f"{payload},{item}" if payload else item
+    if payload:
+        cur.execute("SELECT pg_notify(%s, %s)", (channel, payload))
+
+
+# ===================== PREPARED STATEMENTS =====================
+# Hot queries are PREPAREd once per pooled connection and run via
+# EXECUTE, so Postgres skips parse/plan on the per-update path.
+# The name doubles as the get_conn() metrics label.
+
+HOT_QUERIES = {
+    "ensure_user": """
+        INSERT INTO users (user_id, is_admin)
+        VALUES ($1, $2)
+        ON CONFLICT (user_id) DO NOTHING
+    """,
+    "ensure_user_stats": """
+        INSERT INTO user_stats (user_id)
+        VALUES ($1)
+        ON CONFLICT (user_id) DO NOTHING
+    """,
+    "ensure_user_settings": """
+        INSERT INTO user_settings (user_id)
+        VALUES ($1)
+        ON CONFLICT (user_id) DO NOTHING
+    """,
+    "get_username": "SELECT username FROM user_names WHERE user_id=$1",
+    "notify_replies_enabled": "SELECT notify_replies FROM user_settings WHERE user_id=$1",
+    "get_stats": "SELECT * FROM user_stats WHERE user_id=$1",
+    "is_banned": """
+        SELECT unban_at FROM bans
+        WHERE user_id=$1
+          AND is_active=TRUE
+          AND (unban_at IS NULL OR unban_at > NOW())
+    """,
+    "get_daily_limit": """
+        SELECT topics_created
+        FROM daily_limits
+        WHERE user_id=$1 AND date=$2
+    """,
+    "inc_daily_limit": """
+        INSERT INTO daily_limits (user_id, date, topics_created)
+        VALUES ($1,$2,1)
+        ON CONFLICT (user_id, date)
+        DO UPDATE SET topics_created = daily_limits.topics_created + 1
+    """,
+    "create_topic": """
+        INSERT INTO topics (user_id, text)
+        VALUES ($1,$2)
+        RETURNING id
+    """,
+    "get_topic": """
+        SELECT t.*, u.username
+        FROM topics t
+        JOIN user_names u ON u.user_id=t.user_id
+        WHERE t.id=$1 AND t.is_active=TRUE
+    """,
+    "get_topic_author": """
+        SELECT user_id FROM topics
+        WHERE id=$1 AND is_active=TRUE
+    """,
+    "add_reply": """
+        INSERT INTO replies (topic_id, user_id, text)
+        VALUES ($1,$2,$3)
+    """,
+    "get_replies": """
+        SELECT r.*, u.username
+        FROM replies r
+        JOIN user_names u ON u.user_id=r.user_id
+        WHERE r.topic_id=$1 AND r.is_active=TRUE
+        ORDER BY r.created_at ASC
+        OFFSET $2 LIMIT $3
+    """,
+    "get_feed": """
+        SELECT t.id, t.user_id, t.text, t.created_at, u.username
+        FROM topics t
+        JOIN user_names u ON u.user_id=t.user_id
+        WHERE t.is_active=TRUE
+        ORDER BY t.created_at DESC
+        OFFSET $1 LIMIT $2
+    """,
+}
+
+
+# side-effect free, so the slow-query log may EXPLAIN ANALYZE them
+READ_HOT_QUERIES = frozenset((
+    "get_username", "notify_replies_enabled", "get_stats", "is_banned",
+    "get_daily_limit", "get_topic", "get_topic_author", "get_replies", "get_feed",
+))
+
+
+def execute_prepared(cur, name: str, params: tuple = ()):
+    conn = cur.connection
+    fresh = conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    if name not in conn.prepared:
+        cur.execute(f"PREPARE {name} AS {HOT_QUERIES[name]}")
+        conn.prepared.add(name)
+
+    args = "(" + ",".join(["%s"] * len(params)) + ")" if params else ""
+    try:
+        cur.execute(f"EXECUTE {name}{args}", params)
+    except psycopg2.errors.InvalidSqlStatementName:
+        # the server session was reset behind our back (e.g. by a pooler)
+        conn.prepared.clear()
+        if not fresh:
+            raise
+        conn.rollback()
+        execute_prepared(cur, name, params)
 
 
 def db_ping():
-    with get_conn() as conn:
+    with get_conn("ping") as conn:
         cur = conn.cursor()
         cur.execute("SELECT 1")
 
@@ -99,69 +670,468 @@ bot._notify_command_handlers = safe_call(bot._notify_command_handlers)
 bot._notify_message_handlers = safe_call(bot._notify_message_handlers)
 bot._notify_callback_query_handlers = safe_call(bot._notify_callback_query_handlers)
 
+# ===================== INSTRUMENTATION =====================
+
+_handlers_in_flight = 0
+
+
+def _track_in_flight(delta: int):
+    global _handlers_in_flight
+    with _metrics_lock:
+        _handlers_in_flight += delta
+
+
+def instrumented(label):
+    """
+    Record handler latency and errors.
+    `label` is a fixed name or a function of the incoming update.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(update, *args, **kwargs):
+            name = label(update) if callable(label) else label
+            _request.user_id = update.from_user.id
+            start = time.perf_counter()
+            _track_in_flight(1)
+            try:
+                return func(update, *args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.inc(name)
+                raise
+            finally:
+                _track_in_flight(-1)
+                HANDLER_SECONDS.observe(time.perf_counter() - start, name)
+        return wrapper
+    return decorator
+
+
+_make_request = apihelper._make_request
+
+
+def _instrumented_request(token, method_name, method="get", params=None, files=None):
+    TG_API_CALLS.inc(method_name)
+    start = time.perf_counter()
+    try:
+        return _make_request(token, method_name, method, params=params, files=files)
+    except ApiTelegramException as e:
+        TG_API_ERRORS.inc(method_name, e.error_code)
+        if e.error_code == 429:
+            TG_API_THROTTLED.inc(method_name)
+        raise
+    except Exception:
+        TG_API_ERRORS.inc(method_name, "network")
+        raise
+    finally:
+        TG_API_SECONDS.observe(time.perf_counter() - start, method_name)
+
+
+# ===================== OUTBOUND API =====================
+# One keep-alive session with a sized connection pool for all Telegram
+# calls, per-call timeouts, retries that honour retry_after, and a
+# global send budget that paces senders below Telegram's limits.
+
+class TokenBucket:
+    """Classic token bucket. Not thread-safe: callers hold their own lock."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate, self.burst = rate, burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, now: float) -> float:
+        """Take a token if available; otherwise return seconds until one is."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+TG_RETRIES = Counter("bot_telegram_api_retries_total", "Telegram API retries", ("method", "reason"))
+TG_SEND_WAIT = Histogram("bot_telegram_send_wait_seconds", "Time senders spent waiting for the send budget")
+
+# getUpdates and callback answers do not count against the message limits
+BUDGETED_METHODS = ("send", "edit", "copy", "forward")
+# a 5xx or a dropped connection may come after delivery; resending these duplicates
+NON_IDEMPOTENT_METHODS = ("send", "copy", "forward")
+
+_send_budget = TokenBucket(TG_SEND_RATE, TG_SEND_BURST)
+_send_lock = threading.Lock()
+_sends_paused_until = 0.0
+
+
+def wait_send_slot():
+    start = now = time.monotonic()
+    while True:
+        with _send_lock:
+            delay = max(_sends_paused_until - now, 0) or _send_budget.take(now)
+        if not delay:
+            break
+        time.sleep(delay)
+        now = time.monotonic()
+    if now > start:
+        TG_SEND_WAIT.observe(now - start)
+
+
+def pause_sends(seconds: float):
+    global _sends_paused_until
+    with _send_lock:
+        _sends_paused_until = max(_sends_paused_until, time.monotonic() + seconds)
+
+
+def backoff(attempt: int) -> float:
+    return min(30, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+def _api_request(token, method_name, method="get", params=None, files=None):
+    if method_name.startswith(BUDGETED_METHODS):
+        wait_send_slot()
+
+    # uploads are not replayable once the file object has been read
+    retries = 0 if files else TG_MAX_RETRIES
+    idempotent = not method_name.startswith(NON_IDEMPOTENT_METHODS)
+    for attempt in range(retries + 1):
+        try:
+            return _instrumented_request(token, method_name, method, params=params, files=files)
+        except ApiTelegramException as e:
+            if e.error_code == 429:
+                # pause everyone even when this caller is out of retries
+                retry_after = (e.result_json.get("parameters") or {}).get("retry_after", 1)
+                pause_sends(retry_after)
+                delay = retry_after + random.uniform(0, 1)
+                reason = "429"
+            elif e.error_code >= 500 and idempotent:
+                delay, reason = backoff(attempt), "5xx"
+            else:
+                raise
+            if attempt == retries:
+                raise
+        except requests.exceptions.ConnectionError as e:
+            # only a failed connect is known not to have reached Telegram
+            if attempt == retries or not (idempotent or isinstance(e, requests.exceptions.ConnectTimeout)):
+                raise
+            delay, reason = backoff(attempt), "network"
+
+        TG_RETRIES.inc(method_name, reason)
+        logger.warning(f"Telegram {method_name} failed ({reason}), retry in {delay:.1f}s")
+        time.sleep(delay)
+
+
+def setup_api_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=TG_POOL_SIZE)
+    session.mount("https://", adapter)
+    apihelper.session = session
+    apihelper.SESSION_TIME_TO_LIVE = None
+    apihelper.CONNECT_TIMEOUT = TG_CONNECT_TIMEOUT
+    apihelper.READ_TIMEOUT = TG_READ_TIMEOUT
+    apihelper._make_request = _api_request
+
+
+setup_api_session()
+
+
+def send_quietly(chat_id, text: str, **kwargs) -> bool:
+    """Best-effort send for notifications: failures are logged, not raised."""
+    try:
+        bot.send_message(chat_id, text, **kwargs)
+        return True
+    except ApiTelegramException as e:
+        logger.warning(f"Send to {chat_id} failed: {e.error_code} {e.description}")
+    except Exception:
+        logger.warning(f"Send to {chat_id} failed:")
+        logger.warning(traceback.format_exc())
+    return False
+
+
+# ===================== FLOOD CONTROL =====================
+# Per-user token buckets checked in the polling thread, before an
+# update reaches any handler, DB query or outbound call. Over-limit
+# updates are dropped; the first one of a burst gets a short warning.
+
+FLOOD_LIMITS = {
+    "message": (FLOOD_MSG_RATE, FLOOD_MSG_BURST),
+    "callback": (FLOOD_CB_RATE, FLOOD_CB_BURST),
+}
+FLOOD_DROPPED = Counter("bot_flood_dropped_total", "Updates dropped by flood control", ("kind",))
+
+_flood_buckets = OrderedDict()  # (kind, user_id) -> [TokenBucket, warned]
+_flood_lock = threading.Lock()
+
+
+def flood_check(kind: str, user_id: int):
+    """Returns (allowed, warn); warn is set for the first rejected update of a burst."""
+    now = time.monotonic()
+    key = (kind, user_id)
+    with _flood_lock:
+        entry = _flood_buckets.get(key)
+        if entry is None:
+            entry = _flood_buckets[key] = [TokenBucket(*FLOOD_LIMITS[kind]), False]
+            if len(_flood_buckets) > FLOOD_TABLE_SIZE:
+                _flood_buckets.popitem(last=False)
+        else:
+            _flood_buckets.move_to_end(key)
+
+        if not entry[0].take(now):
+            entry[1] = False
+            return True, False
+        warn = not entry[1]
+        entry[1] = True
+        return False, warn
+
+
+def flood_warn(kind: str, update):
+    if kind == "callback":
+        try:
+            bot.answer_callback_query(update.id, "⏳ Слишком часто, подождите")
+        except Exception:
+            pass
+    else:
+        send_quietly(update.chat.id, "⏳ Слишком часто, подождите немного")
+
+
+def flood_filter(kind: str, process):
+    def wrapper(updates):
+        if _shutting_down.is_set():
+            return
+        allowed = []
+        for update in updates:
+            user = update.from_user
+            if user is None or user.id == ADMIN_ID:
+                allowed.append(update)
+                continue
+            ok, warn = flood_check(kind, user.id)
+            if ok:
+                allowed.append(update)
+                continue
+            FLOOD_DROPPED.inc(kind)
+            if warn:
+                bot._exec_task(flood_warn, kind, update)
+        if allowed:
+            process(allowed)
+    return wrapper
+
+
+bot.process_new_messages = flood_filter("message", bot.process_new_messages)
+bot.process_new_callback_query = flood_filter("callback", bot.process_new_callback_query)
+
+
+WORKER_QUEUE = Gauge(
+    "bot_worker_queue_size", "Updates waiting for a handler thread",
+    fn=lambda: bot.worker_pool.tasks.qsize()
+)
+
 # ============================================================
 # Block 2/8 — Database schema (PostgreSQL)
 # ============================================================
 
-def init_db():
+# ===================== PARTITIONS =====================
+# topics and replies are range-partitioned by month of created_at.
+# Partitions are named <table>_pYYYYMM; a DEFAULT partition catches rows
+# for months that were not created in time, and ensure_partitions()
+# moves them out once their month is created.
+
+PARTITIONED_TABLES = ("topics", "replies")
+
+
+def month_start(d, shift: int = 0):
+    m = d.year * 12 + d.month - 1 + shift
+    return date(m // 12, m % 12 + 1, 1)
+
+
+def partition_name(table: str, month) -> str:
+    return f"{table}_p{month:%Y%m}"
+
+
+def _create_partition(cur, table: str, month, nxt):
+    name = partition_name(table, month)
+    cur.execute(
+        f"SELECT EXISTS (SELECT 1 FROM {table}_default WHERE created_at >= %s AND created_at < %s) AS stray",
+        (month, nxt)
+    )
+    if not cur.fetchone()["stray"]:
+        cur.execute(f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)", (month, nxt))
+        return
+
+    # Postgres refuses a new partition while DEFAULT holds rows of its
+    # range, so take DEFAULT out, move the rows over and put it back
+    cur.execute(f"ALTER TABLE {table} DETACH PARTITION {table}_default")
+    cur.execute(f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)", (month, nxt))
+    cur.execute(f"""
+        WITH moved AS (
+            DELETE FROM {table}_default
+            WHERE created_at >= %s AND created_at < %s
+            RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM moved
+    """, (month, nxt))
+    logger.info(f"Partitions: moved {cur.rowcount} rows from {table}_default to {name}")
+    cur.execute(f"ALTER TABLE {table} ATTACH PARTITION {table}_default DEFAULT")
+
+
+def ensure_partitions(cur, start=None, ahead: int = PARTITIONS_AHEAD, keep_old: bool = False) -> int:
     """
-    Create all tables and indexes if they do not exist.
-    Fully PostgreSQL compatible.
+    Create monthly partitions from `start` (default: this month, or the
+    oldest month with rows stuck in DEFAULT) up to `ahead` months ahead.
+    Months older than ARCHIVE_AFTER_MONTHS are skipped unless `keep_old`:
+    run_retention() has detached them and would clash with a new copy.
     """
-    with get_conn() as conn:
-        cur = conn.cursor()
-
+    today = datetime.utcnow().date()
+    cur.execute("SELECT " + ", ".join(
+        f"(SELECT MIN(created_at)::date FROM {table}_default) AS {table}" for table in PARTITIONED_TABLES
+    ))
+    if isinstance(start, datetime):
+        start = start.date()
+    month = month_start(min([start or today, *(d for d in cur.fetchone().values() if d)]))
+    if not keep_old:
+        month = max(month, month_start(today, -ARCHIVE_AFTER_MONTHS))
+    last = month_start(today, ahead)
+    created = 0
+    while month <= last:
+        nxt = month_start(month, 1)
+        for table in PARTITIONED_TABLES:
+            cur.execute("SELECT to_regclass(%s) AS r", (partition_name(table, month),))
+            if cur.fetchone()["r"] is None:
+                _create_partition(cur, table, month, nxt)
+                created += 1
+        month = nxt
+    return created
+
+
+def migrate_partition_topics_replies(cur):
+    """
+    Rebuild topics and replies as partitioned tables and copy the rows.
+    Unique keys on a partitioned table must include the partition key,
+    so the primary keys become (id, created_at) and the foreign keys
+    to topics(id) from replies and reports are dropped. Ids keep coming
+    from the original sequences.
+    """
+    cur.execute("""
+        SELECT LEAST(
+            (SELECT MIN(created_at) FROM topics),
+            (SELECT MIN(created_at) FROM replies)
+        ) AS oldest
+    """)
+    oldest = cur.fetchone()["oldest"]
+
+    cur.execute("ALTER TABLE topics RENAME TO topics_unpartitioned")
+    cur.execute("ALTER TABLE replies RENAME TO replies_unpartitioned")
+    cur.execute("ALTER SEQUENCE topics_id_seq OWNED BY NONE")
+    cur.execute("ALTER SEQUENCE replies_id_seq OWNED BY NONE")
+
+    cur.execute("""
+    CREATE TABLE topics (
+        id INTEGER NOT NULL DEFAULT nextval('topics_id_seq'),
+        user_id BIGINT REFERENCES users(user_id) ON DELETE CASCADE,
+        text TEXT NOT NULL,
+        is_active BOOLEAN DEFAULT TRUE,
+        created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (id, created_at)
+    ) PARTITION BY RANGE (created_at);
+    """)
+    cur.execute("""
+    CREATE TABLE replies (
+        id INTEGER NOT NULL DEFAULT nextval('replies_id_seq'),
+        topic_id INTEGER NOT NULL,
+        user_id BIGINT REFERENCES users(user_id) ON DELETE CASCADE,
+        text TEXT NOT NULL,
+        is_active BOOLEAN DEFAULT TRUE,
+        created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (id, created_at)
+    ) PARTITION BY RANGE (created_at);
+    """)
+    cur.execute("CREATE TABLE topics_default PARTITION OF topics DEFAULT")
+    cur.execute("CREATE TABLE replies_default PARTITION OF replies DEFAULT")
+    ensure_partitions(cur, start=oldest, keep_old=True)
+
+    cur.execute("""
+        INSERT INTO topics (id, user_id, text, is_active, created_at)
+        SELECT id, user_id, text, is_active, COALESCE(created_at, NOW())
+        FROM topics_unpartitioned
+    """)
+    cur.execute("""
+        INSERT INTO replies (id, topic_id, user_id, text, is_active, created_at)
+        SELECT id, topic_id, user_id, text, is_active, COALESCE(created_at, NOW())
+        FROM replies_unpartitioned
+    """)
+    cur.execute("DROP TABLE replies_unpartitioned")
+    cur.execute("DROP TABLE topics_unpartitioned CASCADE")  # drops reports.topic_id FK
+    cur.execute("ALTER SEQUENCE topics_id_seq OWNED BY topics.id")
+    cur.execute("ALTER SEQUENCE replies_id_seq OWNED BY replies.id")
+
+    cur.execute("CREATE INDEX idx_topics_feed ON topics(created_at DESC) WHERE is_active")
+    cur.execute("CREATE INDEX idx_replies_topic_created ON replies(topic_id, created_at) WHERE is_active")
+
+    # cold storage for soft-deleted rows, see run_retention()
+    cur.execute("CREATE TABLE topics_archive (LIKE topics)")
+    cur.execute("CREATE TABLE replies_archive (LIKE replies)")
+    cur.execute("CREATE INDEX idx_topics_archive_id ON topics_archive(id)")
+    cur.execute("CREATE INDEX idx_replies_archive_topic ON replies_archive(topic_id)")
+
+
+# ===================== MIGRATIONS =====================
+# Ordered (version, name, steps). A step is an SQL string or a callable
+# taking a cursor. Migrations containing CONCURRENTLY run outside a
+# transaction, one statement at a time, so they must be idempotent.
+
+SCHEMA_LOCK_KEY = 72_001  # pg_advisory_lock key serializing migrations
+SCHEMA_LOCK_POLL = 1  # seconds between pg_try_advisory_lock attempts
+PARTITION_LOCK_KEY = 72_003  # pg_try_advisory_xact_lock key for partition maintenance
+
+MIGRATIONS = [
+    (1, "baseline schema", [
         # -------- USERS --------
-        cur.execute("""
+        """
         CREATE TABLE IF NOT EXISTS users (
             user_id BIGINT PRIMARY KEY,
             created_at TIMESTAMP DEFAULT NOW(),
             last_active TIMESTAMP DEFAULT NOW(),
             is_admin BOOLEAN DEFAULT FALSE
         );
-        """)
+        """,
 
         # -------- USER NAMES --------
-        cur.execute("""
+        """
         CREATE TABLE IF NOT EXISTS user_names (
             user_id BIGINT PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE,
             username TEXT UNIQUE NOT NULL,
             updated_at TIMESTAMP DEFAULT NOW()
         );
-        """)
+        """,
 
         # -------- USER SETTINGS --------
-        cur.execute("""
+        """
         CREATE TABLE IF NOT EXISTS user_settings (
             user_id BIGINT PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE,
             notify_replies BOOLEAN DEFAULT TRUE,
             notify_system BOOLEAN DEFAULT TRUE,
             updated_at TIMESTAMP DEFAULT NOW()
         );
-        """)
+        """,
 
         # -------- USER STATS --------
-        cur.execute("""
+        """
         CREATE TABLE IF NOT EXISTS user_stats (
             user_id BIGINT PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE,
             topics_created INTEGER DEFAULT 0,
             replies_written INTEGER DEFAULT 0,
             replies_received INTEGER DEFAULT 0
         );
-        """)
+        """,
 
         # -------- DAILY LIMITS --------
-        cur.execute("""
+        """
         CREATE TABLE IF NOT EXISTS daily_limits (
             user_id BIGINT REFERENCES users(user_id) ON DELETE CASCADE,
             date DATE NOT NULL,
             topics_created INTEGER DEFAULT 0,
             PRIMARY KEY (user_id, date)
         );
-        """)
+        """,
 
         # -------- TOPICS --------
-        cur.execute("""
+        """
         CREATE TABLE IF NOT EXISTS topics (
             id SERIAL PRIMARY KEY,
             user_id BIGINT REFERENCES users(user_id) ON DELETE CASCADE,
@@ -169,10 +1139,10 @@ def init_db():
             is_active BOOLEAN DEFAULT TRUE,
             created_at TIMESTAMP DEFAULT NOW()
         );
-        """)
+        """,
 
         # -------- REPLIES --------
-        cur.execute("""
+        """
         CREATE TABLE IF NOT EXISTS replies (
             id SERIAL PRIMARY KEY,
             topic_id INTEGER REFERENCES topics(id) ON DELETE CASCADE,
@@ -181,10 +1151,10 @@ def init_db():
             is_active BOOLEAN DEFAULT TRUE,
             created_at TIMESTAMP DEFAULT NOW()
         );
-        """)
+        """,
 
         # -------- REPORTS --------
-        cur.execute("""
+        """
         CREATE TABLE IF NOT EXISTS reports (
             id SERIAL PRIMARY KEY,
             topic_id INTEGER REFERENCES topics(id) ON DELETE CASCADE,
@@ -195,10 +1165,10 @@ def init_db():
             created_at TIMESTAMP DEFAULT NOW(),
             resolved_at TIMESTAMP
         );
-        """)
+        """,
 
         # -------- BANS --------
-        cur.execute("""
+        """
         CREATE TABLE IF NOT EXISTS bans (
             user_id BIGINT PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE,
             reason TEXT NOT NULL,
@@ -206,14 +1176,239 @@ def init_db():
             unban_at TIMESTAMP,
             is_active BOOLEAN DEFAULT TRUE
         );
-        """)
+        """,
 
         # -------- INDEXES --------
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_topics_active ON topics(is_active);")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_replies_topic ON replies(topic_id);")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_reports_status ON reports(status);")
+        "CREATE INDEX IF NOT EXISTS idx_topics_active ON topics(is_active);",
+        "CREATE INDEX IF NOT EXISTS idx_replies_topic ON replies(topic_id);",
+        "CREATE INDEX IF NOT EXISTS idx_reports_status ON reports(status);",
+    ]),
+
+    # A failed concurrent build leaves an INVALID index behind, so each
+    # index is dropped first and rebuilt when the migration is retried.
+    (2, "feed and replies indexes", [
+        "DROP INDEX CONCURRENTLY IF EXISTS idx_topics_feed;",
+        "CREATE INDEX CONCURRENTLY idx_topics_feed ON topics(created_at DESC) WHERE is_active;",
+        "DROP INDEX CONCURRENTLY IF EXISTS idx_replies_topic_created;",
+        "CREATE INDEX CONCURRENTLY idx_replies_topic_created ON replies(topic_id, created_at) WHERE is_active;",
+    ]),
+
+    (3, "monthly partitions for topics and replies", [
+        migrate_partition_topics_replies,
+    ]),
+
+    # topics/replies are partitioned and cannot be indexed CONCURRENTLY
+    (4, "moderation indexes", [
+        "DROP INDEX CONCURRENTLY IF EXISTS idx_reports_status_created;",
+        "CREATE INDEX CONCURRENTLY idx_reports_status_created ON reports(status, created_at, id);",
+        "DROP INDEX CONCURRENTLY IF EXISTS idx_reports_status;",
+        "DROP INDEX IF EXISTS idx_topics_user;",
+        "CREATE INDEX idx_topics_user ON topics(user_id);",
+        "DROP INDEX IF EXISTS idx_replies_user;",
+        "CREATE INDEX idx_replies_user ON replies(user_id);",
+    ]),
+
+    (5, "scheduler job runs", [
+        """
+        CREATE TABLE IF NOT EXISTS job_runs (
+            name TEXT PRIMARY KEY,
+            finished_at TIMESTAMP NOT NULL,
+            duration_ms INTEGER NOT NULL,
+            rows INTEGER NOT NULL
+        );
+        """,
+    ]),
 
-        logger.info("Database schema initialized")
+    (6, "topic subscriptions", [
+        """
+        CREATE TABLE IF NOT EXISTS topic_subscriptions (
+            topic_id INTEGER NOT NULL,
+            user_id BIGINT REFERENCES users(user_id) ON DELETE CASCADE,
+            created_at TIMESTAMP DEFAULT NOW(),
+            PRIMARY KEY (topic_id, user_id)
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_user ON topic_subscriptions(user_id);",
+    ]),
+]
+
+LATEST_SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(conn) -> int:
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT MAX(version) AS v FROM schema_version")
+    except psycopg2.errors.UndefinedTable:
+        conn.rollback()
+        return 0
+    return cur.fetchone()["v"] or 0
+
+
+def apply_migration(conn, version: int, name: str, steps):
+    concurrent = any(isinstance(s, str) and "CONCURRENTLY" in s for s in steps)
+    start = time.perf_counter()
+
+    conn.autocommit = concurrent
+    cur = conn.cursor()
+    try:
+        for step in steps:
+            if callable(step):
+                step(cur)
+            else:
+                cur.execute(step)
+        cur.execute(
+            "INSERT INTO schema_version (version, name) VALUES (%s,%s)",
+            (version, name)
+        )
+        conn.commit()
+    except Exception:
+        if not concurrent:
+            conn.rollback()
+        raise
+    finally:
+        conn.autocommit = True
+
+    logger.info(f"Migration {version} ({name}) applied in {time.perf_counter() - start:.2f}s")
+
+
+def init_db():
+    """
+    Bring the schema up to date and make sure this month's partitions
+    exist. Costs a couple of queries when nothing is pending. Partitions
+    are checked on every boot because a machine asleep past the months
+    created ahead would otherwise write into DEFAULT until the retention
+    job runs.
+    """
+    with get_conn("schema_version") as conn:
+        current = get_schema_version(conn)
+    if current < LATEST_SCHEMA_VERSION:
+        migrate()
+    maintain_partitions()
+
+
+def maintain_partitions() -> int:
+    """
+    ensure_partitions() in a transaction of its own. Skipped when another
+    instance is already at it; it does the same work.
+    """
+    with get_conn("ensure_partitions") as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT pg_try_advisory_xact_lock(%s) AS ok", (PARTITION_LOCK_KEY,))
+        if not cur.fetchone()["ok"]:
+            return 0
+        return ensure_partitions(cur)
+
+
+def migrate():
+    """
+    Apply pending migrations under an advisory lock so that concurrently
+    booting instances do not race. Waiters poll pg_try_advisory_lock
+    instead of blocking in pg_advisory_lock: a blocked statement keeps
+    its snapshot open, and CREATE INDEX CONCURRENTLY in the lock holder
+    waits for every older snapshot, which Postgres reports as a deadlock.
+    """
+    with get_conn("migrate") as conn:
+        conn.autocommit = True
+        cur = conn.cursor()
+        while True:
+            cur.execute("SELECT pg_try_advisory_lock(%s) AS locked", (SCHEMA_LOCK_KEY,))
+            if cur.fetchone()["locked"]:
+                break
+            logger.info("Waiting for another instance to finish migrations...")
+            time.sleep(SCHEMA_LOCK_POLL)
+        try:
+            cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT NOW()
+            );
+            """)
+
+            # another instance may have migrated while we waited for the lock
+            current = get_schema_version(conn)
+            for version, name, steps in MIGRATIONS:
+                if version > current:
+                    apply_migration(conn, version, name, steps)
+        finally:
+            cur.execute("SELECT pg_advisory_unlock(%s)", (SCHEMA_LOCK_KEY,))
+
+        logger.info(f"Database schema at version {LATEST_SCHEMA_VERSION}")
+
+
+# ===================== RETENTION =====================
+
+_PARTITION_MONTH = re.compile(r"_p(\d{4})(\d{2})$")
+
+
+def run_retention(cur) -> dict:
+    """
+    Keep active tables small:
+    - make sure upcoming monthly partitions exist (in a transaction of
+      their own, so a failure there does not block archival);
+    - move soft-deleted topics (with all their replies) and soft-deleted
+      replies into topics_archive / replies_archive;
+    - detach partitions older than ARCHIVE_AFTER_MONTHS and rename them
+      <table>_archive_pYYYYMM, so feed, popular and replies only ever
+      scan recent months.
+    """
+    try:
+        result = {"partitions_created": maintain_partitions()}
+    except Exception:
+        logger.error("Retention: creating partitions failed:")
+        logger.error(traceback.format_exc())
+        result = {"partitions_created": 0}
+
+    cur.execute("""
+        WITH gone AS (
+            DELETE FROM topics WHERE is_active=FALSE
+            RETURNING *
+        ), archived_topics AS (
+            INSERT INTO topics_archive SELECT * FROM gone
+            RETURNING 1
+        ), dead AS (
+            DELETE FROM replies
+            WHERE is_active=FALSE OR topic_id IN (SELECT id FROM gone)
+            RETURNING *
+        ), archived_replies AS (
+            INSERT INTO replies_archive SELECT * FROM dead
+            RETURNING 1
+        )
+        SELECT (SELECT COUNT(*) FROM archived_topics) AS topics,
+               (SELECT COUNT(*) FROM archived_replies) AS replies
+    """)
+    row = cur.fetchone()
+    result["topics_archived"] = row["topics"]
+    result["replies_archived"] = row["replies"]
+
+    cutoff = month_start(datetime.utcnow().date(), -ARCHIVE_AFTER_MONTHS)
+    detached = 0
+    for table in PARTITIONED_TABLES:
+        cur.execute("""
+            SELECT c.relname
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid=i.inhrelid
+            WHERE i.inhparent=%s::regclass
+        """, (table,))
+        for name in [r["relname"] for r in cur.fetchall()]:
+            m = _PARTITION_MONTH.search(name)
+            if not m or date(int(m.group(1)), int(m.group(2)), 1) >= cutoff:
+                continue
+            archived = f"{table}_archive_p{m.group(1)}{m.group(2)}"
+            cur.execute(f"ALTER TABLE {table} DETACH PARTITION {name}")
+            cur.execute("SELECT to_regclass(%s) AS r", (archived,))
+            if cur.fetchone()["r"] is None:
+                cur.execute(f"ALTER TABLE {name} RENAME TO {archived}")
+            else:
+                # the month was detached before and re-created since
+                cur.execute(f"INSERT INTO {archived} SELECT * FROM {name}")
+                cur.execute(f"DROP TABLE {name}")
+            detached += 1
+    result["partitions_detached"] = detached
+
+    logger.info(f"Retention: {result}")
+    return result
 
 
 # Initialize DB on startup
@@ -222,8 +1417,6 @@ init_db()
 # Block 3/8 — Users, Names, Settings, Stats, Ranks, Bans
 # ============================================================
 
-import random
-import re
 import html
 
 # ===================== HELPERS =====================
@@ -235,25 +1428,11 @@ def sanitize(text: str) -> str:
 # ===================== USERS =====================
 
 def ensure_user(user_id: int):
-    with get_conn() as conn:
+    with get_conn("ensure_user") as conn:
         cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO users (user_id, is_admin)
-            VALUES (%s, %s)
-            ON CONFLICT (user_id) DO NOTHING
-        """, (user_id, user_id == ADMIN_ID))
-
-        cur.execute("""
-            INSERT INTO user_stats (user_id)
-            VALUES (%s)
-            ON CONFLICT (user_id) DO NOTHING
-        """)
-
-        cur.execute("""
-            INSERT INTO user_settings (user_id)
-            VALUES (%s)
-            ON CONFLICT (user_id) DO NOTHING
-        """)
+        execute_prepared(cur, "ensure_user", (user_id, user_id == ADMIN_ID))
+        execute_prepared(cur, "ensure_user_stats", (user_id,))
+        execute_prepared(cur, "ensure_user_settings", (user_id,))
 
 
 # ===================== USERNAMES =====================
@@ -261,7 +1440,7 @@ def ensure_user(user_id: int):
 def generate_username() -> str:
     while True:
         name = f"аноним_{random.randint(1000, 9999)}"
-        with get_conn() as conn:
+        with get_conn("generate_username") as conn:
             cur = conn.cursor()
             cur.execute("SELECT 1 FROM user_names WHERE username=%s", (name,))
             if not cur.fetchone():
@@ -270,9 +1449,9 @@ def generate_username() -> str:
 
 def get_username(user_id: int) -> str:
     ensure_user(user_id)
-    with get_conn() as conn:
+    with get_conn("get_username") as conn:
         cur = conn.cursor()
-        cur.execute("SELECT username FROM user_names WHERE user_id=%s", (user_id,))
+        execute_prepared(cur, "get_username", (user_id,))
         row = cur.fetchone()
         if row:
             return row["username"]
@@ -282,6 +1461,7 @@ def get_username(user_id: int) -> str:
             INSERT INTO user_names (user_id, username)
             VALUES (%s, %s)
         """, (user_id, name))
+        note_write(user_id)
         return name
 
 
@@ -298,7 +1478,7 @@ def set_username(user_id: int, username: str):
     if not ok:
         return False, err
 
-    with get_conn() as conn:
+    with get_conn("set_username") as conn:
         cur = conn.cursor()
         cur.execute("""
             SELECT 1 FROM user_names
@@ -313,13 +1493,16 @@ def set_username(user_id: int, username: str):
             ON CONFLICT (user_id)
             DO UPDATE SET username=EXCLUDED.username, updated_at=NOW()
         """, (user_id, username))
+        publish(cur, "username", [user_id])
+    note_write(user_id)
+    forget_author(user_id)
     return True, "Имя обновлено"
 
 
 # ===================== SETTINGS =====================
 
 def toggle_notify_replies(user_id: int) -> bool:
-    with get_conn() as conn:
+    with get_conn("toggle_notify_replies") as conn:
         cur = conn.cursor()
         cur.execute("""
             UPDATE user_settings
@@ -332,34 +1515,73 @@ def toggle_notify_replies(user_id: int) -> bool:
 
 
 def notify_replies_enabled(user_id: int) -> bool:
-    with get_conn() as conn:
+    with get_conn("notify_replies_enabled") as conn:
         cur = conn.cursor()
-        cur.execute(
-            "SELECT notify_replies FROM user_settings WHERE user_id=%s",
-            (user_id,)
-        )
+        execute_prepared(cur, "notify_replies_enabled", (user_id,))
         row = cur.fetchone()
         return row["notify_replies"] if row else True
 
 
 # ===================== STATS =====================
 
+# Counters are buffered in memory and written by the flush_stats job,
+# one statement per flush instead of one per reply.
+
+STAT_FIELDS = ("topics_created", "replies_written", "replies_received")
+
+_stat_buffer = {}  # user_id -> [topics_created, replies_written, replies_received]
+_stat_lock = threading.Lock()
+
+
 def inc_stat(user_id: int, field: str):
-    with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute(f"""
-            UPDATE user_stats
-            SET {field} = {field} + 1
-            WHERE user_id=%s
-        """, (user_id,))
+    idx = STAT_FIELDS.index(field)
+    with _stat_lock:
+        _stat_buffer.setdefault(user_id, [0, 0, 0])[idx] += 1
+
+
+def flush_stats() -> int:
+    with _stat_lock:
+        pending = list(_stat_buffer.items())
+        _stat_buffer.clear()
+    if not pending:
+        return 0
+
+    try:
+        with get_conn("flush_stats") as conn:
+            cur = conn.cursor()
+            psycopg2.extras.execute_values(cur, """
+                UPDATE user_stats s
+                SET topics_created = s.topics_created + v.t,
+                    replies_written = s.replies_written + v.w,
+                    replies_received = s.replies_received + v.r
+                FROM (VALUES %s) AS v(user_id, t, w, r)
+                WHERE s.user_id = v.user_id
+            """, [(uid, *deltas) for uid, deltas in pending])
+    except Exception:
+        # put the deltas back for the next flush
+        with _stat_lock:
+            for uid, deltas in pending:
+                row = _stat_buffer.setdefault(uid, [0, 0, 0])
+                for i, d in enumerate(deltas):
+                    row[i] += d
+        raise
+    return len(pending)
 
 
 def get_stats(user_id: int):
     ensure_user(user_id)
-    with get_conn() as conn:
+    with get_conn("get_stats") as conn:
         cur = conn.cursor()
-        cur.execute("SELECT * FROM user_stats WHERE user_id=%s", (user_id,))
-        return cur.fetchone()
+        execute_prepared(cur, "get_stats", (user_id,))
+        stats = dict(cur.fetchone())
+
+    # include this instance's not yet flushed increments
+    with _stat_lock:
+        pending = _stat_buffer.get(user_id)
+        if pending:
+            for field, delta in zip(STAT_FIELDS, pending):
+                stats[field] += delta
+    return stats
 
 
 # ===================== RANKS =====================
@@ -385,21 +1607,56 @@ def get_rank(stats) -> str:
 
 # ===================== BANS =====================
 
+# is_banned runs for every topic and reply; answers are cached for up to
+# BAN_CACHE_TTL (or until a temporary ban ends) and evicted on the "ban"
+# channel whenever any instance bans or unbans.
+
+_ban_cache = OrderedDict()  # user_id -> (banned, valid until, monotonic)
+_ban_lock = threading.Lock()
+# bumped by every eviction; a lookup that raced one must not cache its
+# answer, which may predate the ban that triggered the eviction
+_ban_generation = 0
+
+
 def is_banned(user_id: int) -> bool:
-    with get_conn() as conn:
+    now = time.monotonic()
+    with _ban_lock:
+        hit = _ban_cache.get(user_id)
+    if hit is not None and hit[1] > now:
+        return hit[0]
+    generation = _ban_generation
+
+    with get_conn("is_banned") as conn:
         cur = conn.cursor()
-        cur.execute("""
-            SELECT 1 FROM bans
-            WHERE user_id=%s
-              AND is_active=TRUE
-              AND (unban_at IS NULL OR unban_at > NOW())
-        """, (user_id,))
-        return cur.fetchone() is not None
+        execute_prepared(cur, "is_banned", (user_id,))
+        row = cur.fetchone()
+
+    ttl = BAN_CACHE_TTL
+    if row and row["unban_at"]:
+        ttl = min(ttl, (row["unban_at"] - datetime.utcnow()).total_seconds())
+    with _ban_lock:
+        if generation == _ban_generation:
+            _ban_cache[user_id] = (row is not None, now + ttl)
+            _ban_cache.move_to_end(user_id)
+            if len(_ban_cache) > BAN_CACHE_SIZE:
+                _ban_cache.popitem(last=False)
+    return row is not None
+
+
+def forget_bans(user_ids=None):
+    """Evict `user_ids` from the ban cache, or everyone if None."""
+    global _ban_generation
+    with _ban_lock:
+        _ban_generation += 1
+        if user_ids is None:
+            _ban_cache.clear()
+        for user_id in user_ids or ():
+            _ban_cache.pop(user_id, None)
 
 
 def ban_user(user_id: int, reason: str, days: int = None):
     until = datetime.utcnow() + timedelta(days=days) if days else None
-    with get_conn() as conn:
+    with get_conn("ban_user") as conn:
         cur = conn.cursor()
         cur.execute("""
             INSERT INTO bans (user_id, reason, unban_at, is_active)
@@ -411,15 +1668,19 @@ def ban_user(user_id: int, reason: str, days: int = None):
                 banned_at=NOW(),
                 is_active=TRUE
         """, (user_id, reason, until))
+        publish(cur, "ban", [user_id])
+    forget_bans([user_id])
 
 
 def unban_user(user_id: int):
-    with get_conn() as conn:
+    with get_conn("unban_user") as conn:
         cur = conn.cursor()
         cur.execute(
             "UPDATE bans SET is_active=FALSE WHERE user_id=%s",
             (user_id,)
         )
+        publish(cur, "ban", [user_id])
+    forget_bans([user_id])
 # ============================================================
 # Block 4/8 — Daily limits, Topics, Replies, Notifications
 # ============================================================
@@ -428,13 +1689,9 @@ def unban_user(user_id: int):
 
 def get_daily_limit(user_id: int):
     today = datetime.utcnow().date()
-    with get_conn() as conn:
+    with get_conn("get_daily_limit") as conn:
         cur = conn.cursor()
-        cur.execute("""
-            SELECT topics_created
-            FROM daily_limits
-            WHERE user_id=%s AND date=%s
-        """, (user_id, today))
+        execute_prepared(cur, "get_daily_limit", (user_id, today))
         row = cur.fetchone()
         if not row:
             return DAILY_TOPIC_LIMIT, 0
@@ -444,14 +1701,9 @@ def get_daily_limit(user_id: int):
 
 def inc_daily_limit(user_id: int):
     today = datetime.utcnow().date()
-    with get_conn() as conn:
+    with get_conn("inc_daily_limit") as conn:
         cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO daily_limits (user_id, date, topics_created)
-            VALUES (%s,%s,1)
-            ON CONFLICT (user_id, date)
-            DO UPDATE SET topics_created = daily_limits.topics_created + 1
-        """, (user_id, today))
+        execute_prepared(cur, "inc_daily_limit", (user_id, today))
 
 
 # ===================== TOPICS =====================
@@ -470,39 +1722,34 @@ def create_topic(user_id: int, text: str):
     if len(text) < 5:
         return "short"
 
-    with get_conn() as conn:
+    with get_conn("create_topic") as conn:
         cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO topics (user_id, text)
-            VALUES (%s,%s)
-            RETURNING id
-        """, (user_id, text))
+        execute_prepared(cur, "create_topic", (user_id, text))
         topic_id = cur.fetchone()["id"]
+    note_write(user_id)
 
     inc_daily_limit(user_id)
     inc_stat(user_id, "topics_created")
     return topic_id
 
 
+@replica_read
 def get_topic(topic_id: int):
-    with get_conn() as conn:
+    with get_read_conn("get_topic") as conn:
         cur = conn.cursor()
-        cur.execute("""
-            SELECT t.*, u.username
-            FROM topics t
-            JOIN user_names u ON u.user_id=t.user_id
-            WHERE t.id=%s AND t.is_active=TRUE
-        """, (topic_id,))
+        execute_prepared(cur, "get_topic", (topic_id,))
         return cur.fetchone()
 
 
 def delete_topic(topic_id: int):
-    with get_conn() as conn:
+    with get_conn("delete_topic") as conn:
         cur = conn.cursor()
         cur.execute(
             "UPDATE topics SET is_active=FALSE WHERE id=%s",
             (topic_id,)
         )
+        publish(cur, "topic_deleted", [topic_id])
+    forget_topics([topic_id])
 
 
 # ===================== REPLIES =====================
@@ -517,51 +1764,167 @@ def add_reply(topic_id: int, user_id: int, text: str):
     if len(text) < 2:
         return "short"
 
-    with get_conn() as conn:
+    with get_conn("add_reply") as conn:
         cur = conn.cursor()
-        cur.execute("""
-            SELECT user_id FROM topics
-            WHERE id=%s AND is_active=TRUE
-        """, (topic_id,))
+        execute_prepared(cur, "get_topic_author", (topic_id,))
         row = cur.fetchone()
         if not row:
             return "not_found"
 
         topic_author = row["user_id"]
 
-        cur.execute("""
-            INSERT INTO replies (topic_id, user_id, text)
-            VALUES (%s,%s,%s)
-        """, (topic_id, user_id, text))
+        execute_prepared(cur, "add_reply", (topic_id, user_id, text))
+    note_write(user_id)
 
     inc_stat(user_id, "replies_written")
     inc_stat(topic_author, "replies_received")
 
-    # notify author
-    if topic_author != user_id and notify_replies_enabled(topic_author):
-        try:
-            bot.send_message(
-                topic_author,
-                "💬 На вашу тему пришёл новый ответ"
-            )
-        except Exception:
-            pass
+    # author and followers are notified in batches by fan_out_replies
+    queue_reply_event(topic_id, user_id)
 
     return True
 
 
+@replica_read
 def get_replies(topic_id: int, offset: int = 0, limit: int = REPLIES_PAGE_SIZE):
-    with get_conn() as conn:
+    with get_read_conn("get_replies") as conn:
+        cur = conn.cursor()
+        execute_prepared(cur, "get_replies", (topic_id, offset, limit))
+        return cur.fetchall()
+
+
+# ===================== SUBSCRIPTIONS =====================
+
+def toggle_subscription(topic_id: int, user_id: int) -> bool:
+    """Follow or unfollow a topic; returns True if now following."""
+    with get_conn("toggle_subscription") as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            WITH removed AS (
+                DELETE FROM topic_subscriptions
+                WHERE topic_id=%s AND user_id=%s
+                RETURNING 1
+            )
+            INSERT INTO topic_subscriptions (topic_id, user_id)
+            SELECT %s, %s
+            WHERE NOT EXISTS (SELECT 1 FROM removed)
+            RETURNING 1
+        """, (topic_id, user_id, topic_id, user_id))
+        return cur.fetchone() is not None
+
+
+# ===================== NOTIFICATIONS =====================
+# Replies are buffered and fanned out every NOTIFY_WINDOW_SECONDS:
+# recipients (topic author + followers with notify_replies on) are
+# resolved in one query for all topics of the window, and each
+# recipient gets a single message covering all of them. The messages
+# are sent by a dedicated thread: at TG_SEND_RATE a big window takes
+# minutes, and the scheduler thread must stay free for other jobs.
+
+_reply_events = []  # (topic_id, replier_id)
+_reply_events_lock = threading.Lock()
+
+_digests = deque()  # (user_id, text) waiting to be sent
+_digests_ready = threading.Event()
+
+
+def queue_reply_event(topic_id: int, user_id: int):
+    with _reply_events_lock:
+        _reply_events.append((topic_id, user_id))
+
+
+@replica_read
+def get_reply_recipients(topic_ids: list):
+    """Authors and followers of `topic_ids` who have reply notifications on."""
+    with get_read_conn("get_reply_recipients") as conn:
         cur = conn.cursor()
         cur.execute("""
-            SELECT r.*, u.username
-            FROM replies r
-            JOIN user_names u ON u.user_id=r.user_id
-            WHERE r.topic_id=%s AND r.is_active=TRUE
-            ORDER BY r.created_at ASC
-            OFFSET %s LIMIT %s
-        """, (topic_id, offset, limit))
+            SELECT x.user_id, x.topic_id
+            FROM (
+                SELECT user_id, topic_id FROM topic_subscriptions
+                WHERE topic_id = ANY(%s)
+                UNION
+                SELECT user_id, id FROM topics
+                WHERE id = ANY(%s) AND is_active=TRUE
+            ) x
+            JOIN user_settings s ON s.user_id=x.user_id
+            WHERE s.notify_replies=TRUE
+        """, (topic_ids, topic_ids))
         return cur.fetchall()
+
+
+def fan_out_replies() -> int:
+    with _reply_events_lock:
+        events = _reply_events[:]
+        _reply_events.clear()
+    if not events:
+        return 0
+
+    totals = {}   # topic_id -> replies in this window
+    by_user = {}  # (topic_id, user_id) -> own replies, not notified about
+    for topic_id, user_id in events:
+        totals[topic_id] = totals.get(topic_id, 0) + 1
+        by_user[(topic_id, user_id)] = by_user.get((topic_id, user_id), 0) + 1
+
+    topic_ids = list(totals)
+    try:
+        rows = get_reply_recipients(topic_ids)
+    except Exception:
+        # keep the events for the next window
+        with _reply_events_lock:
+            _reply_events[:0] = events
+        raise
+
+    digest = {}  # recipient -> {topic_id: new replies}
+    for row in rows:
+        uid, topic_id = row["user_id"], row["topic_id"]
+        count = totals[topic_id] - by_user.get((topic_id, uid), 0)
+        if count > 0:
+            digest.setdefault(uid, {})[topic_id] = count
+
+    for uid, topics in digest.items():
+        if len(topics) == 1:
+            (topic_id, count), = topics.items()
+            text = f"💬 Новые ответы в теме #{topic_id}: {count}"
+        else:
+            text = "💬 Новые ответы:\n" + "\n".join(
+                f"• тема #{topic_id}: {count}" for topic_id, count in topics.items()
+            )
+        _digests.append((uid, text))
+    _digests_ready.set()
+    return len(digest)
+
+
+def send_digests(limit=None) -> int:
+    """Send queued digests, at most `limit`; returns how many were sent."""
+    sent = 0
+    while limit is None or sent < limit:
+        try:
+            uid, text = _digests.popleft()
+        except IndexError:
+            break
+        send_quietly(uid, text)
+        sent += 1
+    return sent
+
+
+def run_digest_sender():
+    while True:
+        _digests_ready.wait()
+        _digests_ready.clear()
+        send_digests()
+
+
+def start_digest_sender():
+    threading.Thread(target=run_digest_sender, name="digests", daemon=True).start()
+
+
+def flush_notifications():
+    """Shutdown flush: fan out the open window and send a bounded share of it."""
+    fan_out_replies()
+    send_digests(SHUTDOWN_NOTIFY_LIMIT)
+    if _digests:
+        logger.warning(f"Shutdown: {len(_digests)} reply notifications dropped")
 # ============================================================
 # Block 5/8 — Feeds, Popular, Random, Pagination, Formatting
 # ============================================================
@@ -593,39 +1956,35 @@ def format_reply(reply):
 
 # ===================== FEEDS =====================
 
+@replica_read
 def get_feed(offset: int = 0, limit: int = TOPICS_PAGE_SIZE):
-    with get_conn() as conn:
+    with get_read_conn("get_feed") as conn:
         cur = conn.cursor()
-        cur.execute("""
-            SELECT t.id, t.text, t.created_at, u.username
-            FROM topics t
-            JOIN user_names u ON u.user_id=t.user_id
-            WHERE t.is_active=TRUE
-            ORDER BY t.created_at DESC
-            OFFSET %s LIMIT %s
-        """, (offset, limit))
+        execute_prepared(cur, "get_feed", (offset, limit))
         return cur.fetchall()
 
 
+@replica_read
 def get_popular(limit: int = 5):
-    with get_conn() as conn:
+    with get_read_conn("get_popular") as conn:
         cur = conn.cursor()
         cur.execute("""
-            SELECT t.id, t.text, u.username, COUNT(r.id) AS replies
+            SELECT t.id, t.user_id, t.text, u.username, COUNT(r.id) AS replies
             FROM topics t
             LEFT JOIN replies r
               ON r.topic_id=t.id AND r.is_active=TRUE
             JOIN user_names u ON u.user_id=t.user_id
             WHERE t.is_active=TRUE
-            GROUP BY t.id, u.username
+            GROUP BY t.id, t.created_at, u.username
             ORDER BY replies DESC, t.created_at DESC
             LIMIT %s
         """, (limit,))
         return cur.fetchall()
 
 
+@replica_read
 def get_random_topic():
-    with get_conn() as conn:
+    with get_read_conn("get_random_topic") as conn:
         cur = conn.cursor()
         cur.execute("""
             SELECT id FROM topics
@@ -637,6 +1996,30 @@ def get_random_topic():
         return row["id"] if row else None
 
 
+# Popular is an aggregate over every active reply; it is computed once
+# per POPULAR_REFRESH_SECONDS by the refresh_popular job and shared.
+
+_popular_cache = []
+
+
+def refresh_popular() -> int:
+    global _popular_cache
+    generation = _view_generation
+    topics = get_popular()
+    # a rename or delete while the query ran makes `topics` stale; leave
+    # the cache to the next call instead of restoring old data
+    with _render_lock:
+        if generation == _view_generation:
+            _popular_cache = topics
+    return len(topics)
+
+
+def popular_topics():
+    if not _popular_cache:
+        refresh_popular()
+    return _popular_cache
+
+
 # ===================== KEYBOARDS =====================
 
 def kb_topic(topic_id: int):
@@ -646,6 +2029,7 @@ def kb_topic(topic_id: int):
         InlineKeyboardButton("📖 Ответы", callback_data=f"replies:{topic_id}:0")
     )
     kb.add(
+        InlineKeyboardButton("🔔 Следить", callback_data=f"follow:{topic_id}"),
         InlineKeyboardButton("🚩 Пожаловаться", callback_data=f"report:{topic_id}")
     )
     return kb
@@ -657,6 +2041,89 @@ def kb_feed(offset: int):
         kb.add(InlineKeyboardButton("⬅️ Назад", callback_data=f"feed:{offset-TOPICS_PAGE_SIZE}"))
     kb.add(InlineKeyboardButton("➡️ Далее", callback_data=f"feed:{offset+TOPICS_PAGE_SIZE}"))
     return kb
+
+
+# ===================== RENDER CACHE =====================
+# Ready-to-send (text, reply_markup JSON) per topic. telebot passes a
+# str reply_markup through as is, so cache hits skip both formatting
+# and JSON encoding.
+
+_render_cache = OrderedDict()  # topic_id -> (author_id, text, markup_json)
+_render_lock = threading.Lock()
+# bumped by every invalidation; renders and popular lists built from rows
+# read before a bump are returned but not stored (as with _ban_generation)
+_view_generation = 0
+
+RENDER_CACHE = Counter("bot_render_cache_total", "Rendered topic cache lookups", ("result",))
+
+
+@functools.lru_cache(maxsize=RENDER_CACHE_SIZE)
+def kb_topic_json(topic_id: int) -> str:
+    return kb_topic(topic_id).to_json()
+
+
+def view_generation() -> int:
+    """Take before reading the rows a render or cache fill will be built from."""
+    return _view_generation
+
+
+def _bump_views():
+    global _view_generation
+    _view_generation += 1
+
+
+def render_topic(topic, generation: int):
+    topic_id = topic["id"]
+    with _render_lock:
+        hit = _render_cache.get(topic_id)
+        if hit is not None:
+            _render_cache.move_to_end(topic_id)
+    if hit is not None:
+        RENDER_CACHE.inc("hit")
+        return hit[1], hit[2]
+
+    RENDER_CACHE.inc("miss")
+    text, markup = format_topic(topic), kb_topic_json(topic_id)
+    with _render_lock:
+        if generation == _view_generation:
+            _render_cache[topic_id] = (topic["user_id"], text, markup)
+            if len(_render_cache) > RENDER_CACHE_SIZE:
+                _render_cache.popitem(last=False)
+    return text, markup
+
+
+def invalidate_topic(topic_id: int):
+    with _render_lock:
+        _bump_views()
+        _render_cache.pop(topic_id, None)
+
+
+def invalidate_author(user_id: int):
+    with _render_lock:
+        _bump_views()
+        stale = [tid for tid, entry in _render_cache.items() if entry[0] == user_id]
+        for tid in stale:
+            del _render_cache[tid]
+
+
+def forget_topics(topic_ids):
+    """Drop deleted topics from every in-process view."""
+    global _popular_cache
+    gone = set(topic_ids)
+    for topic_id in gone:
+        invalidate_topic(topic_id)
+    with _render_lock:
+        if any(t["id"] in gone for t in _popular_cache):
+            _popular_cache = [t for t in _popular_cache if t["id"] not in gone]
+
+
+def forget_author(user_id: int):
+    """Drop views showing the old name of `user_id`."""
+    global _popular_cache
+    invalidate_author(user_id)
+    with _render_lock:
+        if any(t["user_id"] == user_id for t in _popular_cache):
+            _popular_cache = []  # refetched by the next popular_topics()
 # ============================================================
 # Block 6/8 — Commands, States, Text Handling
 # ============================================================
@@ -696,6 +2163,7 @@ def kb_main():
 # ===================== COMMANDS =====================
 
 @bot.message_handler(commands=["start"])
+@instrumented("start")
 def cmd_start(message):
     user_id = message.from_user.id
     ensure_user(user_id)
@@ -711,6 +2179,7 @@ def cmd_start(message):
 
 
 @bot.message_handler(commands=["profile"])
+@instrumented("profile")
 def cmd_profile(message):
     user_id = message.from_user.id
     stats = get_stats(user_id)
@@ -735,6 +2204,7 @@ def cmd_profile(message):
 # ===================== TEXT HANDLER =====================
 
 @bot.message_handler(func=lambda m: True)
+@instrumented("text")
 def on_text(message):
     user_id = message.from_user.id
     ensure_user(user_id)
@@ -777,17 +2247,19 @@ def on_text(message):
     elif res == "short":
         bot.send_message(message.chat.id, "⚠️ Тема слишком короткая")
     else:
-        topic = get_topic(res)
+        generation = view_generation()
+        text, markup = render_topic(get_topic(res), generation)
         bot.send_message(
             message.chat.id,
-            "✅ Тема создана:\n\n" + format_topic(topic),
-            reply_markup=kb_topic(res)
+            "✅ Тема создана:\n\n" + text,
+            reply_markup=markup
         )
 # ============================================================
 # Block 7/8 — Callback queries, Feeds, Replies, Reports
 # ============================================================
 
 @bot.callback_query_handler(func=lambda c: True)
+@instrumented(lambda call: "cb_" + call.data.split(":")[0])
 def on_callback(call):
     user_id = call.from_user.id
     ensure_user(user_id)
@@ -798,6 +2270,7 @@ def on_callback(call):
     # ===================== FEED =====================
     if action == "feed":
         offset = int(data[1])
+        generation = view_generation()
         topics = get_feed(offset)
 
         if not topics:
@@ -805,10 +2278,11 @@ def on_callback(call):
             return
 
         for t in topics:
+            text, markup = render_topic(t, generation)
             bot.send_message(
                 call.message.chat.id,
-                format_topic(t),
-                reply_markup=kb_topic(t["id"])
+                text,
+                reply_markup=markup
             )
 
         bot.send_message(
@@ -824,16 +2298,17 @@ def on_callback(call):
             bot.answer_callback_query(call.id, "Тем пока нет")
             return
 
-        topic = get_topic(topic_id)
+        generation = view_generation()
+        text, markup = render_topic(get_topic(topic_id), generation)
         bot.send_message(
             call.message.chat.id,
-            format_topic(topic),
-            reply_markup=kb_topic(topic_id)
+            text,
+            reply_markup=markup
         )
 
     # ===================== POPULAR =====================
     elif action == "popular":
-        topics = get_popular()
+        topics = popular_topics()
         if not topics:
             bot.answer_callback_query(call.id, "Пока пусто")
             return
@@ -844,7 +2319,7 @@ def on_callback(call):
                 f"🔥 <b>{t['username']}</b>\n"
                 f"💬 Ответов: {t['replies']}\n\n"
                 f"{t['text']}",
-                reply_markup=kb_topic(t["id"])
+                reply_markup=kb_topic_json(t["id"])
             )
 
     # ===================== REPLIES =====================
@@ -890,6 +2365,15 @@ def on_callback(call):
             "🔔 Уведомления: " + ("включены" if state else "выключены")
         )
 
+    # ===================== FOLLOW =====================
+    elif action == "follow":
+        following = toggle_subscription(int(data[1]), user_id)
+        bot.answer_callback_query(
+            call.id,
+            "🔔 Вы следите за темой" if following else "🔕 Вы больше не следите за темой"
+        )
+        return
+
     # ===================== REPORT =====================
     elif action == "report":
         topic_id = int(data[1])
@@ -899,6 +2383,11 @@ def on_callback(call):
             "🚩 Укажите причину жалобы:"
         )
 
+    # ===================== REPORT QUEUE (admin) =====================
+    elif action == "reports" and is_admin(user_id):
+        after = (from_micros(int(data[1])), int(data[2])) if len(data) > 2 else None
+        send_report_queue(call.message.chat.id, after)
+
     bot.answer_callback_query(call.id)
 # ============================================================
 # Block 8/8 — Admin, Reports, Safe Polling, Railway
@@ -907,6 +2396,7 @@ def on_callback(call):
 # ===================== REPORT HANDLER =====================
 
 @bot.message_handler(func=lambda m: get_state(m.from_user.id) and get_state(m.from_user.id)["state"] == "report")
+@instrumented("report")
 def handle_report(message):
     user_id = message.from_user.id
     state = get_state(user_id)
@@ -918,7 +2408,7 @@ def handle_report(message):
         bot.send_message(message.chat.id, "⚠️ Причина слишком короткая")
         return
 
-    with get_conn() as conn:
+    with get_conn("add_report") as conn:
         cur = conn.cursor()
         cur.execute("""
             INSERT INTO reports (topic_id, reporter_id, reason)
@@ -929,16 +2419,13 @@ def handle_report(message):
 
     # notify admin
     if ADMIN_ID:
-        try:
-            bot.send_message(
-                ADMIN_ID,
-                f"🚨 <b>Новая жалоба</b>\n"
-                f"Тема #{topic_id}\n"
-                f"От: {get_username(user_id)}\n"
-                f"Причина: {reason}"
-            )
-        except Exception:
-            pass
+        send_quietly(
+            ADMIN_ID,
+            f"🚨 <b>Новая жалоба</b>\n"
+            f"Тема #{topic_id}\n"
+            f"От: {get_username(user_id)}\n"
+            f"Причина: {reason}"
+        )
 
 
 # ===================== ADMIN COMMANDS =====================
@@ -948,6 +2435,7 @@ def is_admin(user_id: int) -> bool:
 
 
 @bot.message_handler(commands=["ban"])
+@instrumented("ban")
 def cmd_ban(message):
     if not is_admin(message.from_user.id):
         return
@@ -961,6 +2449,7 @@ def cmd_ban(message):
 
 
 @bot.message_handler(commands=["unban"])
+@instrumented("unban")
 def cmd_unban(message):
     if not is_admin(message.from_user.id):
         return
@@ -973,12 +2462,171 @@ def cmd_unban(message):
         bot.send_message(message.chat.id, "❌ Использование: /unban user_id")
 
 
+# ===================== BULK MODERATION =====================
+# Each operation is a single set-based statement, so a spam wave is
+# cleaned up in one round trip.
+
+def purge_content(user_id: int = None, since=None, until=None) -> dict:
+    """Soft-delete all active topics and replies matching the filters."""
+    where, params = ["is_active=TRUE"], []
+    if user_id is not None:
+        where.append("user_id=%s")
+        params.append(user_id)
+    if since:
+        where.append("created_at >= %s")
+        params.append(since)
+    if until:
+        where.append("created_at < %s")
+        params.append(until)
+    cond = " AND ".join(where)
+
+    with get_conn("purge_content") as conn:
+        cur = conn.cursor()
+        cur.execute(f"""
+            WITH t AS (
+                UPDATE topics SET is_active=FALSE WHERE {cond} RETURNING id
+            ), r AS (
+                UPDATE replies SET is_active=FALSE WHERE {cond} RETURNING 1
+            )
+            SELECT ARRAY(SELECT id FROM t) AS topics,
+                   (SELECT COUNT(*) FROM r) AS replies
+        """, params * 2)
+        row = cur.fetchone()
+        publish(cur, "topic_deleted", row["topics"])
+
+    forget_topics(row["topics"])
+    return {"topics": len(row["topics"]), "replies": row["replies"]}
+
+
+def resolve_reports(topic_id: int, admin_id: int, status: str = "resolved") -> int:
+    with get_conn("resolve_reports") as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE reports
+            SET status=%s, admin_id=%s, resolved_at=NOW()
+            WHERE topic_id=%s AND status='pending'
+        """, (status, admin_id, topic_id))
+        return cur.rowcount
+
+
+def get_report_queue(after=None, limit: int = REPORTS_PAGE_SIZE):
+    """Pending reports, oldest first; `after` is the (created_at, id) keyset of the last row seen."""
+    with get_conn("get_report_queue") as conn:
+        cur = conn.cursor()
+        if after is None:
+            cur.execute("""
+                SELECT id, topic_id, reason, created_at FROM reports
+                WHERE status='pending'
+                ORDER BY created_at, id
+                LIMIT %s
+            """, (limit,))
+        else:
+            cur.execute("""
+                SELECT id, topic_id, reason, created_at FROM reports
+                WHERE status='pending' AND (created_at, id) > (%s, %s)
+                ORDER BY created_at, id
+                LIMIT %s
+            """, (*after, limit))
+        return cur.fetchall()
+
+
+# callback data is split on ":", so the keyset timestamp travels as
+# microseconds since the epoch rather than an ISO string
+_EPOCH = datetime(1970, 1, 1)
+
+
+def to_micros(ts: datetime) -> int:
+    return (ts - _EPOCH) // timedelta(microseconds=1)
+
+
+def from_micros(micros: int) -> datetime:
+    return _EPOCH + timedelta(microseconds=micros)
+
+
+def send_report_queue(chat_id: int, after=None):
+    reports = get_report_queue(after)
+    if not reports:
+        bot.send_message(chat_id, "✅ Очередь жалоб пуста")
+        return
+
+    lines = [
+        f"#{r['id']} · тема #{r['topic_id']} · {fmt_dt(r['created_at'])}\n"
+        f"{html.escape(html.unescape(r['reason'])[:300])}"
+        for r in reports
+    ]
+    kb = None
+    if len(reports) == REPORTS_PAGE_SIZE:
+        last = reports[-1]
+        kb = InlineKeyboardMarkup().add(InlineKeyboardButton(
+            "➡️ Далее", callback_data=f"reports:{to_micros(last['created_at'])}:{last['id']}"
+        ))
+    bot.send_message(chat_id, "🚩 <b>Жалобы</b>\n\n" + "\n\n".join(lines), reply_markup=kb)
+
+
+@bot.message_handler(commands=["purge_user"])
+@instrumented("purge_user")
+def cmd_purge_user(message):
+    if not is_admin(message.from_user.id):
+        return
+
+    try:
+        _, uid = message.text.split()
+        res = purge_content(user_id=int(uid))
+    except ValueError:
+        bot.send_message(message.chat.id, "❌ Использование: /purge_user user_id")
+        return
+    bot.send_message(message.chat.id, f"🧹 Скрыто тем: {res['topics']}, ответов: {res['replies']}")
+
+
+@bot.message_handler(commands=["purge_window"])
+@instrumented("purge_window")
+def cmd_purge_window(message):
+    if not is_admin(message.from_user.id):
+        return
+
+    try:
+        _, since, until = message.text.split()
+        res = purge_content(since=datetime.fromisoformat(since), until=datetime.fromisoformat(until))
+    except ValueError:
+        bot.send_message(message.chat.id, "❌ Использование: /purge_window 2026-01-01T10:00 2026-01-01T11:00")
+        return
+    bot.send_message(message.chat.id, f"🧹 Скрыто тем: {res['topics']}, ответов: {res['replies']}")
+
+
+@bot.message_handler(commands=["resolve"])
+@instrumented("resolve")
+def cmd_resolve(message):
+    if not is_admin(message.from_user.id):
+        return
+
+    try:
+        _, topic_id, *rest = message.text.split()
+        status = rest[0] if rest else "resolved"
+        if status not in ("resolved", "rejected"):
+            raise ValueError(status)
+        count = resolve_reports(int(topic_id), message.from_user.id, status)
+    except ValueError:
+        bot.send_message(message.chat.id, "❌ Использование: /resolve topic_id [resolved|rejected]")
+        return
+    bot.send_message(message.chat.id, f"✅ Закрыто жалоб: {count}")
+
+
+@bot.message_handler(commands=["reports"])
+@instrumented("reports")
+def cmd_reports(message):
+    if not is_admin(message.from_user.id):
+        return
+
+    send_report_queue(message.chat.id)
+
+
 @bot.message_handler(commands=["stats"])
+@instrumented("stats")
 def cmd_stats(message):
     if not is_admin(message.from_user.id):
         return
 
-    with get_conn() as conn:
+    with get_conn("admin_stats") as conn:
         cur = conn.cursor()
         cur.execute("SELECT COUNT(*) AS c FROM users")
         users = cur.fetchone()["c"]
@@ -996,11 +2644,786 @@ def cmd_stats(message):
     )
 
 
+@bot.message_handler(commands=["archive"])
+@instrumented("archive")
+def cmd_archive(message):
+    if not is_admin(message.from_user.id):
+        return
+
+    result = {}
+
+    def archive(cur):
+        result.update(run_retention(cur))
+        return sum(result.values())
+
+    # same lock and job_runs row as the scheduled job; every=0 skips the
+    # "ran recently" check, an explicit request always runs
+    if run_leader_job("retention", 0, archive) is None:
+        bot.send_message(message.chat.id, "⏳ Архивация уже выполняется на другом экземпляре")
+        return
+
+    bot.send_message(
+        message.chat.id,
+        f"🗄 <b>Архивация</b>\n\n"
+        f"Новых разделов: {result['partitions_created']}\n"
+        f"Тем в архив: {result['topics_archived']}\n"
+        f"Ответов в архив: {result['replies_archived']}\n"
+        f"Отсоединено разделов: {result['partitions_detached']}"
+    )
+
+
+@bot.message_handler(commands=["slowlog"])
+@instrumented("slowlog")
+def cmd_slowlog(message):
+    if not is_admin(message.from_user.id):
+        return
+
+    if not SLOW_PLANS:
+        bot.send_message(
+            message.chat.id,
+            "🐢 Медленных запросов нет" if SLOW_QUERY_MS > 0 else "🐢 Лог медленных запросов выключен"
+        )
+        return
+
+    for ts, ms, sql, plan in list(SLOW_PLANS):
+        bot.send_message(
+            message.chat.id,
+            f"🐢 <b>{ms:.0f} ms</b> {fmt_dt(ts)}\n"
+            f"<code>{html.escape(sql[:500])}</code>\n\n"
+            f"<pre>{html.escape(plan[:3000])}</pre>"
+        )
+
+
+# ===================== SCHEDULER =====================
+# In-process periodic jobs. Leader jobs run in a transaction holding
+# pg_try_advisory_xact_lock and record themselves in job_runs, so with
+# several machines each run happens on exactly one of them. Local jobs
+# (buffers, caches) run on every instance.
+
+JOBS = []  # (name, every seconds, leader, func)
+JOB_LOCK_CLASS = 72_002
+
+JOB_SECONDS = Histogram("bot_job_seconds", "Scheduled job duration", ("job",))
+JOB_ROWS = Counter("bot_job_rows_total", "Rows touched by scheduled jobs", ("job",))
+JOB_FAILURES = Counter("bot_job_failures_total", "Failed scheduled job runs", ("job",))
+
+_scheduler_stop = threading.Event()
+
+
+def scheduled(every: float, leader: bool = True, name: str = None):
+    def decorator(func):
+        JOBS.append((name or func.__name__, every, leader, func))
+        return func
+    return decorator
+
+
+def job_lock_key(name: str) -> int:
+    return (JOB_LOCK_CLASS << 32) | zlib.crc32(name.encode())
+
+
+def run_leader_job(name: str, every: float, func):
+    with get_conn(f"job_{name}") as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT pg_try_advisory_xact_lock(%s) AS ok", (job_lock_key(name),))
+        if not cur.fetchone()["ok"]:
+            return None
+        # another instance may have just finished this run
+        cur.execute("""
+            SELECT 1 FROM job_runs
+            WHERE name=%s AND finished_at > NOW() - %s * INTERVAL '1 second'
+        """, (name, every * 0.9))
+        if cur.fetchone():
+            return None
+
+        start = time.perf_counter()
+        rows = func(cur)
+        cur.execute("""
+            INSERT INTO job_runs (name, finished_at, duration_ms, rows)
+            VALUES (%s, NOW(), %s, %s)
+            ON CONFLICT (name) DO UPDATE SET
+                finished_at=EXCLUDED.finished_at,
+                duration_ms=EXCLUDED.duration_ms,
+                rows=EXCLUDED.rows
+        """, (name, int((time.perf_counter() - start) * 1000), rows))
+        return rows
+
+
+def run_job(name: str, every: float, leader: bool, func):
+    start = time.perf_counter()
+    try:
+        rows = run_leader_job(name, every, func) if leader else func()
+    except Exception:
+        JOB_FAILURES.inc(name)
+        logger.error(f"Job {name} failed:")
+        logger.error(traceback.format_exc())
+        return
+    if rows is None:
+        return
+
+    duration = time.perf_counter() - start
+    JOB_SECONDS.observe(duration, name)
+    JOB_ROWS.inc(name, amount=rows)
+    if rows:
+        logger.info(f"Job {name}: {rows} rows in {duration:.2f}s")
+
+
+def run_scheduler():
+    # spread first runs so instances booting together do not collide
+    due = {name: time.monotonic() + random.uniform(0, min(every, 30)) for name, every, _, _ in JOBS}
+    while not _scheduler_stop.is_set():
+        now = time.monotonic()
+        for name, every, leader, func in JOBS:
+            if due[name] <= now:
+                run_job(name, every, leader, func)
+                due[name] = time.monotonic() + every
+        _scheduler_stop.wait(max(0.0, min(due.values()) - time.monotonic()))
+
+
+def start_scheduler():
+    threading.Thread(target=run_scheduler, name="scheduler", daemon=True).start()
+    logger.info(f"Scheduler started: {', '.join(name for name, *_ in JOBS)}")
+
+
+@scheduled(every=STATS_FLUSH_SECONDS, leader=False, name="flush_stats")
+def job_flush_stats():
+    return flush_stats()
+
+
+@scheduled(every=POPULAR_REFRESH_SECONDS, leader=False, name="refresh_popular")
+def job_refresh_popular():
+    return refresh_popular()
+
+
+@scheduled(every=NOTIFY_WINDOW_SECONDS, leader=False, name="fan_out_replies")
+def job_fan_out_replies():
+    return fan_out_replies()
+
+
+@scheduled(every=60)
+def expire_bans(cur):
+    cur.execute("""
+        UPDATE bans SET is_active=FALSE
+        WHERE is_active=TRUE AND unban_at <= NOW()
+    """)
+    return cur.rowcount
+
+
+@scheduled(every=3600)
+def prune_daily_limits(cur):
+    cur.execute(
+        "DELETE FROM daily_limits WHERE date < CURRENT_DATE - %s",
+        (DAILY_LIMITS_KEEP_DAYS,)
+    )
+    return cur.rowcount
+
+
+@scheduled(every=86400)
+def prune_reports(cur):
+    cur.execute("""
+        DELETE FROM reports
+        WHERE status <> 'pending'
+          AND resolved_at < NOW() - %s * INTERVAL '1 day'
+    """, (REPORTS_KEEP_DAYS,))
+    return cur.rowcount
+
+
+@scheduled(every=86400)
+def retention(cur):
+    return sum(run_retention(cur).values())
+
+
+@bot.message_handler(commands=["jobs"])
+@instrumented("jobs")
+def cmd_jobs(message):
+    if not is_admin(message.from_user.id):
+        return
+
+    with get_conn("job_runs") as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM job_runs ORDER BY name")
+        runs = cur.fetchall()
+
+    lines = [
+        f"<b>{r['name']}</b>: {fmt_dt(r['finished_at'])}, {r['duration_ms']} ms, строк: {r['rows']}"
+        for r in runs
+    ]
+    bot.send_message(message.chat.id, "⏱ <b>Задачи</b>\n\n" + ("\n".join(lines) or "Ещё не запускались"))
+
+
+# ===================== EXPORT =====================
+# Streams topics and replies with usernames in constant memory:
+# CSV through COPY ... TO STDOUT, JSONL through a server-side cursor
+# read in EXPORT_BATCH_SIZE batches. Rows moved out by run_retention()
+# (the *_archive tables and detached *_archive_pYYYYMM months) are
+# included and marked source='archive' unless active_only is set.
+
+EXPORT_COLUMNS = ("type", "id", "topic_id", "user_id", "username", "text", "is_active", "created_at", "source")
+TELEGRAM_UPLOAD_LIMIT = 50 * 1024 * 1024
+
+
+def export_sources(cur, active_only: bool = False) -> dict:
+    """Map 'topics'/'replies' to [(table, source)] to read from."""
+    sources = {table: [(table, "active")] for table in PARTITIONED_TABLES}
+    if active_only:
+        return sources
+    cur.execute("""
+        SELECT relname FROM pg_class
+        WHERE relkind='r' AND relname ~ '^(topics|replies)_archive(_p[0-9]{6})?$'
+        ORDER BY relname
+    """)
+    for row in cur.fetchall():
+        name = row["relname"]
+        sources[name.split("_", 1)[0]].append((name, "archive"))
+    return sources
+
+
+def export_query(cur, sources: dict, since=None, until=None) -> bytes:
+    where, params = [], []
+    if since:
+        where.append("x.created_at >= %s")
+        params.append(since)
+    if until:
+        where.append("x.created_at < %s")
+        params.append(until)
+    cond = ("WHERE " + " AND ".join(where)) if where else ""
+
+    parts = []
+    for table, source in sources["topics"]:
+        parts.append(f"""
+            SELECT 'topic' AS type, x.id, NULL::INTEGER AS topic_id, x.user_id,
+                   u.username, x.text, x.is_active, x.created_at, '{source}' AS source
+            FROM {table} x
+            LEFT JOIN user_names u ON u.user_id=x.user_id
+            {cond}
+        """)
+    for table, source in sources["replies"]:
+        parts.append(f"""
+            SELECT 'reply' AS type, x.id, x.topic_id, x.user_id,
+                   u.username, x.text, x.is_active, x.created_at, '{source}' AS source
+            FROM {table} x
+            LEFT JOIN user_names u ON u.user_id=x.user_id
+            {cond}
+        """)
+    return cur.mogrify(" UNION ALL ".join(parts), params * len(parts))
+
+
+def export_archive(out, fmt: str = "jsonl", since=None, until=None, active_only: bool = False) -> int:
+    """Write the archive to binary file object `out`; returns the row count."""
+    with get_read_conn("export") as conn:
+        cur = conn.cursor()
+        cur.execute("SET LOCAL statement_timeout = 0")  # exports outlast REPLICA_STATEMENT_TIMEOUT_MS
+        sql = export_query(cur, export_sources(cur, active_only), since, until)
+        if fmt == "csv":
+            cur.copy_expert(f"COPY ({sql.decode()}) TO STDOUT WITH CSV HEADER", out)
+            return cur.rowcount
+
+        cur = conn.cursor(name="export", cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute(sql)
+        total = 0
+        while True:
+            rows = cur.fetchmany(EXPORT_BATCH_SIZE)
+            if not rows:
+                return total
+            out.write(b"".join(
+                json.dumps(row, ensure_ascii=False, default=str).encode() + b"\n"
+                for row in rows
+            ))
+            total += len(rows)
+
+
+def export_to_file(path: str, fmt: str = "jsonl", since=None, until=None,
+                   compress: bool = True, active_only: bool = False) -> int:
+    opener = gzip.open if compress else open
+    with opener(path, "wb") as out:
+        return export_archive(out, fmt, since, until, active_only)
+
+
+def export_to_chat(chat_id: int, fmt: str, since=None, until=None):
+    try:
+        _export_to_chat(chat_id, fmt, since, until)
+    except Exception as e:
+        # runs on its own thread: without this the admin only ever sees "запущен"
+        logger.error("Export failed:")
+        logger.error(traceback.format_exc())
+        send_quietly(chat_id, f"❌ Экспорт не удался: {html.escape(type(e).__name__)}")
+
+
+def _export_to_chat(chat_id: int, fmt: str, since=None, until=None):
+    name = f"archive-{datetime.utcnow():%Y%m%d-%H%M}.{fmt}.gz"
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, name)
+        start = time.perf_counter()
+        rows = export_to_file(path, fmt, since, until)
+        size = os.path.getsize(path)
+        logger.info(f"Export: {rows} rows, {size} bytes in {time.perf_counter() - start:.1f}s")
+
+        if size > TELEGRAM_UPLOAD_LIMIT:
+            bot.send_message(
+                chat_id,
+                f"⚠️ Архив слишком большой для Telegram ({size // 1024 // 1024} МБ).\n"
+                "Используйте: <code>python archive.py export</code>"
+            )
+            return
+        with open(path, "rb") as f:
+            bot.send_document(chat_id, f, visible_file_name=name, caption=f"📦 Строк: {rows}")
+
+
+@bot.message_handler(commands=["export"])
+@instrumented("export")
+def cmd_export(message):
+    if not is_admin(message.from_user.id):
+        return
+
+    try:
+        _, *args = message.text.split()
+        fmt = args[0] if args else "jsonl"
+        if fmt not in ("jsonl", "csv"):
+            raise ValueError(fmt)
+        since = datetime.fromisoformat(args[1]) if len(args) > 1 else None
+        until = datetime.fromisoformat(args[2]) if len(args) > 2 else None
+    except Exception:
+        bot.send_message(message.chat.id, "❌ Использование: /export [jsonl|csv] [с YYYY-MM-DD] [до YYYY-MM-DD]")
+        return
+
+    bot.send_message(message.chat.id, "⏳ Экспорт запущен")
+
+    # large exports take minutes; keep the handler threads free
+    threading.Thread(
+        target=export_to_chat,
+        args=(message.chat.id, fmt, since, until),
+        name="export",
+        daemon=True
+    ).start()
+
+
+# ===================== BULK IMPORT =====================
+# Loads records in the export format through COPY FROM STDIN into
+# temporary staging tables, then merges them set-based: users, names,
+# settings and stats first, then topics and replies, then user_stats
+# incremented by what was inserted. Ids are preserved and checked
+# against the live and the archive tables, so importing the same export
+# twice is a no-op. Records exported from the archive, or older than
+# ARCHIVE_AFTER_MONTHS, go to topics_archive / replies_archive.
+
+IMPORT_COLUMNS = {
+    "topic": ("id", "user_id", "username", "text", "is_active", "created_at", "source"),
+    "reply": ("id", "topic_id", "user_id", "username", "text", "is_active", "created_at", "source"),
+}
+
+# secondary indexes on the bulk-loaded tables, rebuilt once at the end
+# instead of being maintained row by row
+BULK_INDEXES = {
+    "idx_topics_feed": "CREATE INDEX idx_topics_feed ON topics(created_at DESC) WHERE is_active",
+    "idx_replies_topic_created": "CREATE INDEX idx_replies_topic_created ON replies(topic_id, created_at) WHERE is_active",
+    "idx_topics_user": "CREATE INDEX idx_topics_user ON topics(user_id)",
+    "idx_replies_user": "CREATE INDEX idx_replies_user ON replies(user_id)",
+}
+
+
+def _copy_field(value) -> str:
+    if value is None:
+        return "\\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def _copy_batch(cur, kind: str, lines: list):
+    cols = ", ".join(IMPORT_COLUMNS[kind])
+    cur.copy_expert(f"COPY import_{kind} ({cols}) FROM STDIN", io.StringIO("".join(lines)))
+    lines.clear()
+
+
+def bulk_load(records, defer_indexes: bool = False) -> dict:
+    """Load an iterable of export-format dicts; returns inserted row counts."""
+    start = time.perf_counter()
+    with get_conn("bulk_load") as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            CREATE TEMP TABLE import_topic (
+                id INTEGER, user_id BIGINT, username TEXT,
+                text TEXT, is_active BOOLEAN, created_at TIMESTAMP, source TEXT
+            ) ON COMMIT DROP
+        """)
+        cur.execute("""
+            CREATE TEMP TABLE import_reply (
+                id INTEGER, topic_id INTEGER, user_id BIGINT, username TEXT,
+                text TEXT, is_active BOOLEAN, created_at TIMESTAMP, source TEXT
+            ) ON COMMIT DROP
+        """)
+
+        buffers = {"topic": [], "reply": []}
+        staged = 0
+        for rec in records:
+            kind = rec["type"]
+            buffers[kind].append(
+                "\t".join(_copy_field(rec.get(col)) for col in IMPORT_COLUMNS[kind]) + "\n"
+            )
+            if len(buffers[kind]) >= IMPORT_BATCH_SIZE:
+                _copy_batch(cur, kind, buffers[kind])
+            staged += 1
+        for kind, lines in buffers.items():
+            if lines:
+                _copy_batch(cur, kind, lines)
+        logger.info(f"Import: {staged} rows staged in {time.perf_counter() - start:.1f}s")
+
+        cur.execute("ANALYZE import_topic")
+        cur.execute("ANALYZE import_reply")
+        cur.execute("""
+            CREATE TEMP TABLE import_user ON COMMIT DROP AS
+            SELECT DISTINCT ON (user_id) user_id, username
+            FROM (
+                SELECT user_id, username FROM import_topic
+                UNION ALL
+                SELECT user_id, username FROM import_reply
+            ) x
+            WHERE user_id IS NOT NULL
+            ORDER BY user_id, username NULLS LAST
+        """)
+
+        cur.execute("INSERT INTO users (user_id) SELECT user_id FROM import_user ON CONFLICT DO NOTHING")
+        cur.execute("INSERT INTO user_stats (user_id) SELECT user_id FROM import_user ON CONFLICT DO NOTHING")
+        cur.execute("INSERT INTO user_settings (user_id) SELECT user_id FROM import_user ON CONFLICT DO NOTHING")
+        cur.execute("""
+            INSERT INTO user_names (user_id, username)
+            SELECT user_id, username FROM import_user
+            WHERE username IS NOT NULL
+            ON CONFLICT DO NOTHING
+        """)
+        # topics and replies are only visible with a name; cover users
+        # whose name was missing or already taken
+        cur.execute("""
+            INSERT INTO user_names (user_id, username)
+            SELECT user_id, 'аноним_' || user_id FROM import_user
+            ON CONFLICT DO NOTHING
+        """)
+
+        cutoff = month_start(datetime.utcnow().date(), -ARCHIVE_AFTER_MONTHS)
+        for kind in ("topic", "reply"):
+            # a file may repeat an id; keep its first record
+            cur.execute(f"DELETE FROM import_{kind} a USING import_{kind} b WHERE a.id=b.id AND a.ctid > b.ctid")
+            # run_retention() would have moved these out already
+            cur.execute(f"UPDATE import_{kind} SET source='archive' WHERE created_at < %s", (cutoff,))
+
+        cur.execute("""
+            SELECT LEAST(
+                (SELECT MIN(created_at) FROM import_topic WHERE source IS DISTINCT FROM 'archive'),
+                (SELECT MIN(created_at) FROM import_reply WHERE source IS DISTINCT FROM 'archive')
+            ) AS oldest
+        """)
+        ensure_partitions(cur, start=cur.fetchone()["oldest"])
+
+        # the partitioned primary key is (id, created_at), so ON CONFLICT
+        # could not catch an id from another database. Ids already present
+        # in the live or archive tables are skipped; if the id belongs to a
+        # different topic, the replies to it are skipped as well rather
+        # than being attached to the wrong topic.
+        sources = {table: [name for name, _ in found] for table, found in export_sources(cur).items()}
+        _collect(cur, "taken_topic", sources["topics"], "SELECT id FROM import_topic", "id, created_at")
+        _collect(cur, "taken_reply", sources["replies"], "SELECT id FROM import_reply", "id")
+        cur.execute("""
+            WITH foreign_topics AS (
+                DELETE FROM import_topic i
+                USING taken_topic t
+                WHERE t.id=i.id AND t.created_at IS DISTINCT FROM i.created_at
+                RETURNING i.id
+            )
+            DELETE FROM import_reply
+            WHERE topic_id IN (SELECT id FROM foreign_topics)
+        """)
+        if cur.rowcount:
+            logger.warning(f"Import: {cur.rowcount} replies skipped, their topic id belongs to another topic")
+        cur.execute("DELETE FROM import_topic WHERE id IN (SELECT id FROM taken_topic)")
+        cur.execute("DELETE FROM import_reply WHERE id IN (SELECT id FROM taken_reply)")
+
+        if defer_indexes:
+            for name in BULK_INDEXES:
+                cur.execute(f"DROP INDEX IF EXISTS {name}")
+
+        cur.execute("CREATE TEMP TABLE added_topic (id INTEGER, user_id BIGINT) ON COMMIT DROP")
+        cur.execute("CREATE TEMP TABLE added_reply (topic_id INTEGER, user_id BIGINT) ON COMMIT DROP")
+        result = {"topics": 0, "replies": 0}
+        for target, archived in (("", "IS DISTINCT FROM"), ("_archive", "=")):
+            cur.execute(f"""
+                WITH added AS (
+                    INSERT INTO topics{target} (id, user_id, text, is_active, created_at)
+                    SELECT id, user_id, text, COALESCE(is_active, TRUE), COALESCE(created_at, NOW())
+                    FROM import_topic
+                    WHERE source {archived} 'archive'
+                    RETURNING id, user_id
+                )
+                INSERT INTO added_topic SELECT id, user_id FROM added
+            """)
+            result["topics"] += cur.rowcount
+            cur.execute(f"""
+                WITH added AS (
+                    INSERT INTO replies{target} (id, topic_id, user_id, text, is_active, created_at)
+                    SELECT id, topic_id, user_id, text, COALESCE(is_active, TRUE), COALESCE(created_at, NOW())
+                    FROM import_reply
+                    WHERE source {archived} 'archive'
+                    RETURNING topic_id, user_id
+                )
+                INSERT INTO added_reply SELECT topic_id, user_id FROM added
+            """)
+            result["replies"] += cur.rowcount
+
+        if defer_indexes:
+            for sql in BULK_INDEXES.values():
+                cur.execute(sql)
+
+        # archived ids count too: a sequence behind them would hand them out again
+        for table in PARTITIONED_TABLES:
+            top = " UNION ALL ".join(f"SELECT MAX(id) AS id FROM {name}" for name in sources[table])
+            cur.execute(f"SELECT setval('{table}_id_seq', GREATEST((SELECT MAX(id) FROM ({top}) x), 1))")
+
+        _collect(cur, "added_author", sources["topics"], "SELECT topic_id FROM added_reply", "id, user_id")
+        result["users"] = add_import_stats(cur)
+
+    logger.info(f"Import: {result} in {time.perf_counter() - start:.1f}s")
+    return result
+
+
+def _collect(cur, temp: str, tables, ids_sql: str, cols: str):
+    """Gather `cols` of the rows of `tables` whose id is in `ids_sql` into temp table `temp`."""
+    cur.execute(f"CREATE TEMP TABLE {temp} ON COMMIT DROP AS SELECT {cols} FROM {tables[0]} WHERE FALSE")
+    for table in tables:
+        cur.execute(f"INSERT INTO {temp} SELECT {cols} FROM {table} WHERE id IN ({ids_sql})")
+
+
+def add_import_stats(cur) -> int:
+    """
+    Add the rows just imported (added_topic / added_reply) to user_stats.
+    Incrementing rather than recounting keeps counts of archived rows and
+    does not race with deltas still buffered by running bots.
+    """
+    cur.execute("""
+        WITH v AS (
+            SELECT user_id, SUM(t) AS t, SUM(w) AS w, SUM(r) AS r
+            FROM (
+                SELECT user_id, 1 AS t, 0 AS w, 0 AS r FROM added_topic
+                UNION ALL
+                SELECT user_id, 0, 1, 0 FROM added_reply
+                UNION ALL
+                SELECT a.user_id, 0, 0, 1
+                FROM added_reply x
+                JOIN added_author a ON a.id=x.topic_id
+            ) x
+            GROUP BY user_id
+        )
+        UPDATE user_stats s
+        SET topics_created = s.topics_created + v.t,
+            replies_written = s.replies_written + v.w,
+            replies_received = s.replies_received + v.r
+        FROM v
+        WHERE s.user_id=v.user_id
+    """)
+    return cur.rowcount
+
+
+def read_jsonl(path: str):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+# ===================== SEEDER =====================
+
+SEED_WORDS = (
+    "мысль", "день", "город", "море", "книга", "время", "музыка", "работа", "друг", "кофе",
+    "сон", "дождь", "вопрос", "ответ", "жизнь", "утро", "вечер", "дорога", "память", "идея",
+)
+
+
+def reserve_ids(cur, sequence: str, n: int) -> int:
+    """
+    Advance `sequence` by n and return the first id of the block.
+    Not atomic against concurrent inserts; seeding is for test databases.
+    """
+    cur.execute("SELECT nextval(%s) AS first", (sequence,))
+    first = cur.fetchone()["first"]
+    cur.execute("SELECT setval(%s, %s)", (sequence, first + n - 1))
+    return first
+
+
+def synthetic_records(users: int, topics: int, replies: int, first_topic: int, first_reply: int, days: int = 365):
+    """
+    Generate export-format records. Synthetic users get negative ids,
+    which never collide with real Telegram users.
+    """
+    now = time.time()
+    created = array("d")
+
+    def text(lo, hi):
+        return " ".join(random.choices(SEED_WORDS, k=random.randint(lo, hi)))
+
+    for i in range(topics):
+        uid = -random.randint(1, users)
+        ts = now - random.random() * days * 86400
+        created.append(ts)
+        yield {
+            "type": "topic", "id": first_topic + i, "user_id": uid, "username": f"seed_{-uid}",
+            "text": text(3, 30), "is_active": True, "created_at": datetime.utcfromtimestamp(ts),
+        }
+
+    for i in range(replies):
+        uid = -random.randint(1, users)
+        idx = random.randrange(topics)
+        ts = min(now, created[idx] + random.random() * 3 * 86400)
+        yield {
+            "type": "reply", "id": first_reply + i, "topic_id": first_topic + idx, "user_id": uid,
+            "username": f"seed_{-uid}", "text": text(1, 15), "is_active": True,
+            "created_at": datetime.utcfromtimestamp(ts),
+        }
+
+
+def seed(users: int, topics: int, replies: int, defer_indexes: bool = False) -> dict:
+    with get_conn("seed_reserve") as conn:
+        cur = conn.cursor()
+        first_topic = reserve_ids(cur, "topics_id_seq", max(topics, 1))
+        first_reply = reserve_ids(cur, "replies_id_seq", max(replies, 1))
+    return bulk_load(
+        synthetic_records(users, topics, replies, first_topic, first_reply),
+        defer_indexes
+    )
+
+
+# ===================== HTTP (health, metrics) =====================
+
+web = Flask(__name__)
+
+
+@web.route("/health")
+def http_health():
+    return "ok"
+
+
+@web.route("/metrics")
+def http_metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+def run_web():
+    threading.Thread(
+        target=lambda: web.run(host="0.0.0.0", port=PORT),
+        name="http",
+        daemon=True
+    ).start()
+    logger.info(f"HTTP server listening on :{PORT}")
+
+
+# ===================== INVALIDATION BUS (listen) =====================
+
+def _ids(payload: str):
+    return [int(x) for x in payload.split(",") if x]
+
+
+INVALIDATION_HANDLERS = {
+    "ban": lambda payload: forget_bans(_ids(payload)),
+    "username": lambda payload: [forget_author(uid) for uid in _ids(payload)],
+    "topic_deleted": lambda payload: forget_topics(_ids(payload)),
+}
+INVALIDATIONS = Counter("bot_invalidations_total", "Invalidation messages received", ("channel",))
+
+
+def clear_local_caches():
+    global _popular_cache
+    with _render_lock:
+        _bump_views()
+        _render_cache.clear()
+    forget_bans()
+    _popular_cache = []
+
+
+def listen_invalidations():
+    """
+    Evict local state on NOTIFYs from any instance. LISTEN needs a
+    session of its own, so this uses a dedicated connection outside the
+    pool; after a reconnect everything is dropped because messages may
+    have been missed.
+    """
+    while not _shutting_down.is_set():
+        conn = None
+        try:
+            conn = psycopg2.connect(DATABASE_URL, sslmode="require")
+            conn.autocommit = True
+            cur = conn.cursor()
+            for channel in INVALIDATION_HANDLERS:
+                cur.execute(f"LISTEN {channel}")
+            clear_local_caches()
+            logger.info("Listening for cache invalidations")
+
+            while not _shutting_down.is_set():
+                if select.select([conn], [], [], 5) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    note = conn.notifies.pop(0)
+                    INVALIDATIONS.inc(note.channel)
+                    INVALIDATION_HANDLERS[note.channel](note.payload)
+        except Exception:
+            logger.error("Invalidation listener failed, reconnecting...")
+            logger.error(traceback.format_exc())
+            time.sleep(RECONNECT_DELAY)
+        finally:
+            if conn is not None:
+                conn.close()
+
+
+def start_listener():
+    threading.Thread(target=listen_invalidations, name="invalidations", daemon=True).start()
+
+
+# ===================== GRACEFUL SHUTDOWN =====================
+# On SIGTERM/SIGINT: stop polling (updates not yet acknowledged are
+# redelivered to the next instance), let handler threads finish, then
+# flush write-behind buffers before exiting.
+
+_shutting_down = threading.Event()
+
+
+def drain_and_exit():
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    while time.monotonic() < deadline and (bot.worker_pool.tasks.qsize() or _handlers_in_flight):
+        time.sleep(0.1)
+    if _handlers_in_flight:
+        logger.warning(f"Shutdown: {_handlers_in_flight} handlers still running")
+
+    _scheduler_stop.set()
+    for name, flush in (("stats", flush_stats), ("notifications", flush_notifications)):
+        try:
+            flush()
+        except Exception:
+            logger.error(f"Shutdown: flushing {name} failed:")
+            logger.error(traceback.format_exc())
+
+    for pool in _pools.values():
+        pool.closeall()
+    logger.info("Shutdown complete")
+    logging.shutdown()
+    os._exit(0)
+
+
+def on_shutdown_signal(signum, frame):
+    if _shutting_down.is_set():
+        return
+    _shutting_down.set()
+    logger.info(f"Received signal {signum}, draining...")
+    bot.stop_polling()
+    # the main thread is stuck in a long poll; drain from a thread of its own
+    threading.Thread(target=drain_and_exit, name="shutdown").start()
+
+
 # ===================== SAFE POLLING =====================
 
 def run_bot():
     logger.info("Bot started polling")
-    while True:
+    while not _shutting_down.is_set():
         try:
             bot.infinity_polling(
                 timeout=30,
@@ -1010,8 +3433,65 @@ def run_bot():
             logger.error("Polling crashed, restarting...")
             logger.error(traceback.format_exc())
             time.sleep(RECONNECT_DELAY)
+    _shutting_down.wait()
+
+
+# ===================== CLI =====================
+
+def cli_export(argv):
+    parser = argparse.ArgumentParser(prog="archive.py export", description="Export topics and replies")
+    parser.add_argument("--format", choices=("jsonl", "csv"), default="jsonl")
+    parser.add_argument("--since", type=datetime.fromisoformat)
+    parser.add_argument("--until", type=datetime.fromisoformat)
+    parser.add_argument("--gzip", action="store_true", help="gzip-compress the output")
+    parser.add_argument("--active-only", action="store_true", help="skip rows moved out by retention")
+    parser.add_argument("--out", required=True, help="output file")
+    args = parser.parse_args(argv)
+
+    rows = export_to_file(args.out, args.format, args.since, args.until, args.gzip, args.active_only)
+    logger.info(f"Exported {rows} rows to {args.out}")
+
+
+def cli_import(argv):
+    parser = argparse.ArgumentParser(prog="archive.py import", description="Bulk-load a JSONL export")
+    parser.add_argument("path", help="JSONL file, optionally .gz")
+    parser.add_argument("--defer-indexes", action="store_true", help="rebuild indexes once after loading")
+    args = parser.parse_args(argv)
+
+    bulk_load(read_jsonl(args.path), args.defer_indexes)
+
+
+def cli_seed(argv):
+    parser = argparse.ArgumentParser(prog="archive.py seed", description="Load synthetic data")
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--topics", type=int, default=100_000)
+    parser.add_argument("--replies", type=int, default=1_000_000)
+    parser.add_argument("--defer-indexes", action="store_true", help="rebuild indexes once after loading")
+    args = parser.parse_args(argv)
+    if args.replies > 0 and args.topics <= 0:
+        parser.error("--replies needs at least one topic to reply to")
+
+    seed(args.users, args.topics, args.replies, args.defer_indexes)
+
+
+COMMANDS = {
+    "export": cli_export,
+    "import": cli_import,
+    "seed": cli_seed,
+}
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, on_shutdown_signal)
+    signal.signal(signal.SIGINT, on_shutdown_signal)
+
     db_ping()
+    run_web()
+    start_listener()
+    start_digest_sender()
+    start_scheduler()
     run_bot()